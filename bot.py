@@ -4,20 +4,23 @@ from discord.ext import commands
 
 
 import aiohttp
-import asyncpg
+import asyncio
+import collections
 import datetime
+import heapq
 import json
 import logging
+import os
+import re
 import sys
 import time
 
-from cogs.utils import config
+from cogs.utils import cache, config, db, ipc, metrics, monitor, tracing
 
 log = logging.getLogger("robo_coder")
 logging.basicConfig(level=logging.INFO, format="(%(asctime)s) %(levelname)s %(message)s", datefmt="%m/%d/%y - %H:%M:%S %Z")
 
 extensions = [
-    "cogs.admin",
     "cogs.fun",
     "cogs.games",
     "cogs.internet",
@@ -30,16 +33,35 @@ extensions = [
     "cogs.logging"
 ]
 
+# Rarely used extensions that are loaded in the background once the bot is ready, so they don't hold up startup
+deferred_extensions = [
+    "jishaku",
+    "cogs.admin"
+]
+
 
 def get_prefix(bot, message):
-    default_prefixes = getattr(bot.config, "default_prefixes", ["r!", "r."])
+    matcher = bot.get_prefix_matcher(message.guild.id if message.guild else None)
+    prefix = matcher.match(message.content)
+
+    # An empty list tells discord.py that no prefix matched
+    return prefix if prefix is not None else []
+
+
+class PrefixMatcher:
+    """Finds which of a set of prefixes a message starts with in a single regex match."""
 
-    prefixes = [f"<@!{bot.user.id}> ", f"<@{bot.user.id}> "]
-    if message.guild:
-        prefixes.extend(bot.prefixes.get(message.guild.id, default_prefixes))
-    else:
-        prefixes.extend(default_prefixes + ["!"])
-    return prefixes
+    __slots__ = ("prefixes", "_match")
+
+    def __init__(self, prefixes):
+        self.prefixes = tuple(prefixes)
+
+        # Alternation tries each prefix in order, so the first prefix that matches wins like it does in discord.py
+        self._match = re.compile("|".join(re.escape(prefix) for prefix in self.prefixes)).match
+
+    def match(self, content):
+        match = self._match(content)
+        return match[0] if match else None
 
 
 class RoboCoderTree(app_commands.CommandTree):
@@ -61,6 +83,11 @@ class RoboCoderTree(app_commands.CommandTree):
         self._cached_commands[guild.id if guild else None] = commands
         return commands
 
+    async def _call(self, interaction):
+        name = interaction.data.get("name") if interaction.data else None
+        with self.client.tracer.trace(f"/{name}" if name else "interaction", guild_id=interaction.guild_id, user_id=interaction.user.id):
+            await super()._call(interaction)
+
     async def mention_for(self, name, *, guild = None):
         if guild not in self._cached_commands:
             await self.fetch_commands(guild=guild)
@@ -69,13 +96,87 @@ class RoboCoderTree(app_commands.CommandTree):
         return command.mention if command else None
 
 
-class RoboCoder(commands.Bot):
+class AdmissionControl:
+    """Rejects blacklisted and ratelimited users with a constant cost per message."""
+
+    def __init__(self, bot, *, rate=15, per=12):
+        self.bot = bot
+        self.rate = rate
+        self.per = per
+
+        self.cooldowns = {}
+        self.stats = collections.Counter()
+        self._expiries = []
+
+    def __len__(self):
+        return len(self.cooldowns)
+
+    async def check(self, message):
+        # Returns the reason the message was rejected, or None if it was admitted
+        # Every message is checked, not just commands, so these are only logged at debug level
+        if await self.bot.get_blacklisted(message.author) is not None:
+            reason = "blacklisted_user"
+            log.debug("Ignoring message from blacklisted user %s (%s).", message.author.name, message.author.id)
+        elif message.guild is not None and await self.bot.get_blacklisted(message.guild) is not None:
+            reason = "blacklisted_guild"
+            log.debug("Ignoring message in blacklisted guild %s (%s).", message.guild.name, message.guild.id)
+        else:
+            self.stats["admitted"] += 1
+            return None
+
+        self.stats[reason] += 1
+        return reason
+
+    def update_rate_limit(self, message):
+        now = message.created_at.timestamp()
+        self.evict(now)
+
+        cooldown = self.cooldowns.get(message.author.id)
+        if cooldown is None:
+            cooldown = self.cooldowns[message.author.id] = commands.Cooldown(rate=self.rate, per=self.per)
+            heapq.heappush(self._expiries, (now + self.per, message.author.id))
+
+        cooldown.update_rate_limit(now)
+        tokens = cooldown.get_tokens(now)
+
+        if tokens < 5:
+            self.stats["ratelimited"] += 1
+        else:
+            self.stats["hits"] += 1
+
+        return cooldown, tokens
+
+    def evict(self, now):
+        # Buckets are kept in a min-heap ordered by expiry, with exactly one entry per bucket.
+        # An entry that comes up while its bucket is still in use is pushed back with the real expiry.
+        while self._expiries and self._expiries[0][0] < now:
+            expires_at, user_id = heapq.heappop(self._expiries)
+            cooldown = self.cooldowns.get(user_id)
+
+            if cooldown is None:
+                continue
+
+            expires_at = cooldown._last + cooldown.per
+            if now > expires_at:
+                del self.cooldowns[user_id]
+                self.stats["evicted"] += 1
+            else:
+                heapq.heappush(self._expiries, (expires_at, user_id))
+
+
+class RoboCoder(commands.AutoShardedBot):
     def __init__(self):
         intents = discord.Intents.all()
         intents.presences = False
         intents.typing = False
 
+        # These are set by launcher.py when the bot is running as one of several clusters
+        shard_ids = os.environ.get("ROBO_CODER_SHARD_IDS")
+        shard_count = os.environ.get("ROBO_CODER_SHARD_COUNT")
+
         super().__init__(
+            shard_ids=[int(shard_id) for shard_id in shard_ids.split(",")] if shard_ids else None,
+            shard_count=int(shard_count) if shard_count else None,
             command_prefix=get_prefix,
             description="A multipurpose bot. Likes to code for fun.",
             case_insensitive=True,
@@ -87,19 +188,128 @@ class RoboCoder(commands.Bot):
         self.support_server_invite = "https://discord.gg/6jQpPeEtQM"
         self.players = {}
 
-        self.global_cooldowns = {}
+        self.admission = AdmissionControl(self)
+        self._prefix_matchers = {}
+
+        self.cluster_id = int(os.environ.get("ROBO_CODER_CLUSTER_ID", 0))
+        self.cluster_count = int(os.environ.get("ROBO_CODER_CLUSTER_COUNT", 1))
+
+        # Cogs register their metrics on this even when the endpoint is disabled
+        self.metrics = metrics.Registry()
+        self.metrics_server = None
+        self.register_metrics()
+
+        self.tracer = tracing.Tracer(
+            filename=getattr(self.config, "trace_file", "traces.jsonl"),
+            max_bytes=getattr(self.config, "trace_file_max_bytes", 50 * 1024 * 1024)
+        )
+
+    @property
+    def is_primary(self):
+        # The primary cluster owns the config files and anything that isn't tied to a guild
+        return self.cluster_id == 0
 
     async def setup_hook(self):
-        self.prefixes = config.Config("prefixes.json")
-        self.blacklist = config.Config("blacklist.json")
+        started_at = time.perf_counter()
+        self.startup_timings = {}
+
+        # Steps that ran alongside others, so their times overlap and include waiting on each other
+        self.concurrent_steps = set()
+        self.deferred_extensions = list(deferred_extensions)
+
+        # Executor work, HTTP requests and Discord API calls record spans when made during a traced command
+        self.loop.set_default_executor(tracing.TracingExecutor())
+        self.http.request = tracing.traced("discord", self.http.request)
+
+        self.ipc = ipc.Client(
+            self,
+            cluster_id=self.cluster_id,
+            cluster_count=self.cluster_count,
+            port=int(os.environ["ROBO_CODER_IPC_PORT"]) if "ROBO_CODER_IPC_PORT" in os.environ else None,
+            secret=os.environ.get("ROBO_CODER_IPC_SECRET")
+        )
+        self.ipc.add_handler("stopall", self.handle_stopall)
+        self.ipc.start()
+
+        self.prefixes = config.Config("prefixes.json", persist=self.is_primary)
+        self.blacklist = config.Config("blacklist.json", persist=self.is_primary)
+        self.prefixes.on_change = self.blacklist.on_change = self.broadcast_config_change
+
+        # Parse the config files off the loop instead of delaying startup
+        self.loop.create_task(self.prefixes.load())
+        self.loop.create_task(self.blacklist.load())
         self.uptime = discord.utils.utcnow()
-        self.session = aiohttp.ClientSession()
+        self.session = aiohttp.ClientSession(trace_configs=[tracing.trace_config()])
 
         if self.config.console_webhook_url is not None:
             self.console = discord.Webhook.from_url(self.config.console_webhook_url, session=self.session)
         else:
             self.console = None
 
+        self.monitor = monitor.LoopMonitor(
+            self.loop,
+            threshold=getattr(self.config, "slow_callback_threshold", 0.25),
+            on_slow_callback=self.report_slow_callback
+        )
+        self.monitor.start()
+        self._last_slow_callback_report = 0
+
+        metrics_port = getattr(self.config, "metrics_port", None)
+        if metrics_port is not None:
+            # Every cluster serves its own metrics on the port after the previous cluster's
+            self.metrics_server = metrics.MetricsServer(self.metrics, port=metrics_port + self.cluster_id)
+            await self.metrics_server.start()
+
+        # None of the extensions touch the database or emojis while loading, so everything can start at once
+        await asyncio.gather(
+            self.timed_step("database", self.setup_database(), concurrent=True),
+            self.timed_step("emojis", self.load_emojis(), concurrent=True),
+            *[self.timed_step(extension, self.load_startup_extension(extension), concurrent=True) for extension in extensions]
+        )
+
+        self.startup_timings["total"] = time.perf_counter() - started_at
+        log.info("Finished setup in %.2fs.", self.startup_timings["total"])
+
+        self.loop.create_task(self.load_deferred_extensions())
+
+    def register_metrics(self):
+        self.commands_invoked = self.metrics.counter("commands_total", "Commands invoked, by command and whether they failed", ["command", "status"])
+        self.command_duration = self.metrics.histogram("command_duration_seconds", "Time spent invoking commands", ["command"])
+
+        self.metrics.counter("admission_total", "Messages seen by admission control, by outcome", ["outcome"], function=lambda: dict(self.admission.stats))
+        self.metrics.gauge("cooldowns", "Users with an active global cooldown bucket", function=lambda: len(self.admission))
+
+        self.metrics.gauge("gateway_latency_seconds", "Gateway heartbeat latency", ["shard"], function=lambda: {shard_id: shard.latency for shard_id, shard in self.shards.items()})
+        self.metrics.gauge("guilds", "Guilds the bot is in", function=lambda: len(self.guilds))
+        self.metrics.gauge("players", "Active music players", function=lambda: len(self.players))
+
+        self.metrics.gauge("loop_lag_seconds", "Most recent event loop lag", function=lambda: self.monitor.lag)
+        self.metrics.counter("slow_callbacks_total", "Callbacks that blocked the event loop for longer than the threshold", function=lambda: self.monitor.slow_callbacks)
+
+        self.metrics.gauge("db_pool_connections", "Database pool connections, by state", ["state"], function=lambda: {"idle": self.db.pool_idle, "in_use": self.db.pool_size - self.db.pool_idle})
+        self.metrics.counter("db_acquire_timeouts_total", "Times acquiring a database connection timed out", function=lambda: self.db.acquire_timeouts)
+
+        self.metrics.counter("cache_requests_total", "Cached function lookups, by cache and result", ["cache", "result"], function=self.collect_cache_stats)
+        self.metrics.counter("cache_evictions_total", "Entries evicted from full caches", ["cache"], function=lambda: {name: lru.stats.evictions for name, lru in cache.caches.items()})
+        self.metrics.gauge("cache_entries", "Entries held by each cache", ["cache"], function=lambda: {name: len(lru) for name, lru in cache.caches.items()})
+
+    def collect_cache_stats(self):
+        stats = {}
+        for name, lru in cache.caches.items():
+            stats[(name, "hit")] = lru.stats.hits
+            stats[(name, "miss")] = lru.stats.misses
+        return stats
+
+    async def timed_step(self, name, coro, *, concurrent=False):
+        started_at = time.perf_counter()
+        try:
+            return await coro
+        finally:
+            self.startup_timings[name] = time.perf_counter() - started_at
+            if concurrent:
+                self.concurrent_steps.add(name)
+
+    async def setup_database(self):
         async def init(connection):
             await connection.set_type_codec(
                 "jsonb",
@@ -108,22 +318,73 @@ class RoboCoder(commands.Bot):
                 decoder=json.loads,
                 format="text"
             )
-        self.db = await asyncpg.create_pool(self.config.database_uri, init=init)
+        self.db = await db.Database.create(self.config.database_uri, init=init)
 
         with open("schema.sql") as file:
             schema = file.read()
-            await self.db.execute(schema)
 
-        with open("assets/emojis.json") as file:
-            self.default_emojis = json.load(file)
+        await self.timed_step("schema", self.db.execute(schema), concurrent=True)
+
+        # Cached guild settings are invalidated in every process, not just the one that changed them
+        self.invalidation = cache.InvalidationBus(self.db)
+        await self.invalidation.start()
+        cache.bus = self.invalidation
+
+    async def load_emojis(self):
+        def load():
+            with open("assets/emojis.json") as file:
+                return json.load(file)
 
-        await self.load_extension("jishaku")
+        self.default_emojis = await self.loop.run_in_executor(None, load)
 
+    async def load_startup_extension(self, extension):
+        try:
+            await self.load_extension(extension)
+        except Exception as exc:
+            log.info("Failure while loading extension %s.", extension, exc_info=exc)
+
+    async def load_deferred_extensions(self):
+        await self.wait_until_ready()
+        extensions, self.deferred_extensions = self.deferred_extensions, []
+
+        # One at a time, so each one's time is its own
         for extension in extensions:
-            try:
-                await self.load_extension(extension)
-            except Exception as exc:
-                log.info("Failure while loading extension %s.", extension, exc_info=exc)
+            log.info("Loading deferred extension %s.", extension)
+            await self.timed_step(extension, self.load_startup_extension(extension))
+
+    def broadcast_config_change(self, store, key, value, deleted):
+        if self.cluster_count > 1:
+            self.loop.create_task(self.ipc.broadcast("config_update", {"filename": store.filename, "key": key, "value": value, "deleted": deleted}))
+
+    async def on_ipc_config_update(self, data):
+        if data["filename"] == self.prefixes.filename:
+            self.prefixes.apply(data["key"], data["value"], data["deleted"])
+            self.invalidate_prefixes(int(data["key"]))
+        elif data["filename"] == self.blacklist.filename:
+            self.blacklist.apply(data["key"], data["value"], data["deleted"])
+
+            guild = self.get_guild(int(data["key"]))
+            if guild is not None and not data["deleted"]:
+                await guild.leave()
+
+    def report_slow_callback(self, offender):
+        if self.console is None or not getattr(self.config, "report_slow_callbacks", False):
+            return
+
+        # A slow loop tends to stay slow, so don't flood the webhook
+        if time.monotonic() - self._last_slow_callback_report < 60:
+            return
+        self._last_slow_callback_report = time.monotonic()
+
+        em = discord.Embed(title=":snail: Event Loop Blocked", description="", color=discord.Color.gold())
+        em.description += f"\nDuration: `{int(offender.duration*1000)}ms`"
+        em.description += f"\nLocation: `{offender.location}`"
+        em.description += f"\n\n```py\n{offender.format_stack()[-3500:]}```"
+
+        self.loop.create_task(self.console.send(embed=em))
+
+    async def handle_stopall(self, data):
+        return await self.stop_players()
 
     async def on_ready(self):
         log.info(f"Logged in as {self.user.name} - {self.user.id}.")
@@ -144,23 +405,19 @@ class RoboCoder(commands.Bot):
         if message.author.bot:
             return
 
-        ctx = await self.get_context(message)
+        is_owner = message.author.id == self.owner_id
 
-        if not ctx.valid:
+        # Blacklisted users and guilds are rejected before the message is parsed
+        if not is_owner and await self.admission.check(message) is not None:
             return
 
-        if message.author.id != self.owner_id:
-            if await self.get_blacklisted(message.author) is not None:
-                return log.warning("Ignoring command from blacklisted user %s (%s).", message.author.name, message.author.id)
-            if message.guild is not None and await self.get_blacklisted(message.guild) is not None:
-                return log.warning("Ignoring command in blacklisted guild %s (%s).", message.guild.name, message.guild.id)
+        ctx = await self.get_context(message)
 
-            if message.author.id not in self.global_cooldowns:
-                self.global_cooldowns[message.author.id] = commands.Cooldown(rate=15, per=12)
+        if not ctx.valid:
+            return
 
-            cooldown = self.global_cooldowns[message.author.id]
-            cooldown.update_rate_limit(message.created_at.timestamp())
-            tokens = cooldown.get_tokens(message.created_at.timestamp())
+        if not is_owner:
+            cooldown, tokens = self.admission.update_rate_limit(message)
 
             if tokens == 0:
                 log.warning("User %s (%s) has been permanently blacklisted for spamming.", message.author.name, message.author.id)
@@ -180,18 +437,27 @@ class RoboCoder(commands.Bot):
             elif tokens < 5:
                 return
 
-            # remove "dead" cooldowns
-            for user_id, cooldown in self.global_cooldowns.copy().items():
-                if message.created_at.timestamp() > cooldown._last + cooldown.per:
-                    del self.global_cooldowns[user_id]
+        started_at = time.perf_counter()
+        with self.tracer.trace(ctx.command.qualified_name, guild_id=message.guild.id if message.guild else None, user_id=message.author.id):
+            await self.invoke(ctx)
 
-        await self.invoke(ctx)
+        name = ctx.command.qualified_name
+        self.command_duration.observe(time.perf_counter() - started_at, command=name)
+        self.commands_invoked.inc(command=name, status="failed" if ctx.command_failed else "completed")
 
     async def close(self):
         await self.stop_players()
+        self.monitor.close()
+        if self.metrics_server:
+            await self.metrics_server.close()
+        await self.ipc.close()
+        await self.prefixes.close()
+        await self.blacklist.close()
+        await self.invalidation.close()
         await self.db.close()
         await self.session.close()
         await super().close()
+        self.tracer.close()
 
     def run(self):
         super().run(self.config.token)
@@ -201,7 +467,26 @@ class RoboCoder(commands.Bot):
         return prefixes[0]
 
     def get_guild_prefixes(self, guild_id):
-        return self.prefixes.get(guild_id, getattr(self.config, "default_prefixes", ["r!", "r."]))
+        # Callers edit the returned list, so it must never be the stored one
+        return list(self.prefixes.get(guild_id, getattr(self.config, "default_prefixes", ["r!", "r."])))
+
+    def get_prefix_matcher(self, guild_id):
+        try:
+            return self._prefix_matchers[guild_id]
+        except KeyError:
+            pass
+
+        prefixes = [f"<@!{self.user.id}> ", f"<@{self.user.id}> "]
+        if guild_id is not None:
+            prefixes.extend(self.get_guild_prefixes(guild_id))
+        else:
+            prefixes.extend(getattr(self.config, "default_prefixes", ["r!", "r."]) + ["!"])
+
+        matcher = self._prefix_matchers[guild_id] = PrefixMatcher(prefixes)
+        return matcher
+
+    def invalidate_prefixes(self, guild_id):
+        self._prefix_matchers.pop(guild_id, None)
 
     async def stop_players(self):
         player_count = len(self.players)
@@ -216,5 +501,6 @@ class RoboCoder(commands.Bot):
     def config(self):
         return __import__("config")
 
-bot = RoboCoder()
-bot.run()
+if __name__ == "__main__":
+    bot = RoboCoder()
+    bot.run()
@@ -16,7 +16,7 @@ import traceback
 from jishaku import codeblocks
 from typing import Union
 
-from .utils import formats, human_time, menus
+from .utils import cache, formats, human_time, menus
 
 
 class Admin(commands.Cog):
@@ -141,15 +141,14 @@ class Admin(commands.Cog):
 
         execute = query.count(";") > 1
 
-        if execute:
-            method = self.bot.db.execute
-        else:
-            method = self.bot.db.fetch
-
         try:
-            start = time.time()
-            results = await method(query)
-            end = time.time()
+            # Run on a connection of its own, since one-off queries would only clutter the query stats
+            async with self.bot.db.acquire() as connection:
+                method = connection.execute if execute else connection.fetch
+
+                start = time.time()
+                results = await method(query)
+                end = time.time()
         except Exception as e:
             full = "".join(traceback.format_exception(type(e), e, e.__traceback__))
             return await ctx.send(f"```py\n{full}```")
@@ -173,6 +172,171 @@ class Admin(commands.Cog):
         except discord.HTTPException:
             await ctx.send(file=discord.File(io.BytesIO(str(results).encode("utf-8")), filename="result.txt"))
 
+    @commands.command(description="Shows which queries are using the most database time", aliases=["sqlstats"])
+    async def dbstats(self, ctx, limit: int = 15):
+        queries = sorted(self.bot.db.queries.values(), key=lambda stats: stats.total_time, reverse=True)[:limit]
+
+        if not queries:
+            return await ctx.send("No queries have been run yet")
+
+        table = formats.Tabulate()
+        table.add_columns(["Query", "Calls", "Errors", "Rows", "Total", "Avg", "P99", "Max"])
+        for stats in queries:
+            table.add_row([
+                stats.name if len(stats.name) <= 40 else f"{stats.name[:37]}...",
+                stats.calls,
+                stats.errors,
+                stats.rows,
+                f"{int(stats.total_time*1000)}ms",
+                f"{stats.average_time*1000:.2f}ms",
+                f"{stats.percentile(99)*1000:.2f}ms",
+                f"{stats.max_time*1000:.2f}ms"
+            ])
+
+        db = self.bot.db
+        pool = (
+            f"Pool: {db.pool_size - db.pool_idle}/{db.pool_size} in use (max {db.pool_max_size}) | "
+            f"Wait: {db.average_wait_time*1000:.2f}ms avg, {db.max_wait_time*1000:.2f}ms max | "
+            f"Acquire timeouts: {db.acquire_timeouts}"
+        )
+
+        results = f"{pool}\n\n{table}"
+        try:
+            await ctx.send(f"```\n{results}```")
+        except discord.HTTPException:
+            await ctx.send(file=discord.File(io.BytesIO(results.encode("utf-8")), filename="dbstats.txt"))
+
+    @commands.command(description="Shows hit rates and sizes of the function caches")
+    async def cachestats(self, ctx):
+        if not cache.caches:
+            return await ctx.send("No caches have been created")
+
+        table = formats.Tabulate()
+        table.add_columns(["Cache", "Size", "Hits", "Misses", "Coalesced", "Hit Rate", "Evictions", "Expired"])
+        for name, lru in sorted(cache.caches.items()):
+            table.add_row([
+                name.removeprefix("cogs."),
+                f"{len(lru)}/{lru.max_size}",
+                lru.stats.hits,
+                lru.stats.misses,
+                lru.stats.coalesced,
+                f"{lru.stats.hit_rate*100:.1f}%",
+                lru.stats.evictions,
+                lru.stats.expirations
+            ])
+
+        bus = cache.bus
+        invalidations = f"Invalidations: {bus.published} published, {bus.received} received from other processes" if bus else "Invalidations: not connected"
+        await ctx.send(f"```\n{invalidations}\n\n{table}```")
+
+    @commands.command(description="Shows how long each step of startup took")
+    async def startup(self, ctx):
+        timings = sorted(self.bot.startup_timings.items(), key=lambda timing: timing[1], reverse=True)
+
+        table = formats.Tabulate()
+        table.add_columns(["Step", "Time", "Concurrent"])
+        table.add_rows([(name, f"{int(seconds*1000)}ms", "yes" if name in self.bot.concurrent_steps else "") for name, seconds in timings])
+
+        await ctx.send(f"```\n{table}\n\nConcurrent steps ran at the same time, so their times overlap```")
+
+    @commands.command(description="Shows event loop lag and the callbacks that blocked it the longest", aliases=["slowcallbacks"])
+    async def lag(self, ctx, offender: int = None):
+        monitor = self.bot.monitor
+        offenders = monitor.offenders
+
+        if offender is not None:
+            if not 0 < offender <= len(offenders):
+                return await ctx.send(":x: Invalid offender")
+
+            offender = offenders[offender-1]
+            stack = offender.format_stack() or "Stack wasn't captured"
+            results = f"Blocked for {int(offender.duration*1000)}ms {humanize.naturaltime(offender.occurred_at.replace(tzinfo=None), when=datetime.datetime.utcnow())}\n\n{stack}"
+
+            try:
+                return await ctx.send(f"```py\n{results}```")
+            except discord.HTTPException:
+                return await ctx.send(file=discord.File(io.BytesIO(results.encode("utf-8")), filename="stack.txt"))
+
+        summary = (
+            f"Lag: {monitor.lag*1000:.2f}ms now, {monitor.average_lag*1000:.2f}ms avg (1m), {monitor.max_lag*1000:.2f}ms max | "
+            f"Slow callbacks: {monitor.slow_callbacks} (threshold {int(monitor.threshold*1000)}ms)"
+        )
+
+        if not offenders:
+            return await ctx.send(f"```\n{summary}```")
+
+        table = formats.Tabulate()
+        table.add_columns(["#", "Duration", "When", "Location"])
+        table.add_rows([
+            (
+                index,
+                f"{int(offender.duration*1000)}ms",
+                humanize.naturaltime(offender.occurred_at.replace(tzinfo=None), when=datetime.datetime.utcnow()),
+                offender.location
+            )
+            for index, offender in enumerate(offenders, start=1)
+        ])
+
+        results = f"{summary}\n\n{table}"
+        try:
+            await ctx.send(f"```\n{results}```")
+        except discord.HTTPException:
+            await ctx.send(file=discord.File(io.BytesIO(results.encode("utf-8")), filename="lag.txt"))
+
+    @commands.command(description="Shows the slowest recent traces, or the spans of one trace")
+    async def traces(self, ctx, trace_id=None):
+        tracer = self.bot.tracer
+
+        if trace_id is not None:
+            trace = tracer.get(trace_id)
+            if trace is None:
+                return await ctx.send(":x: Trace not found")
+
+            # Children are indented under their parent span
+            depths = {None: -1}
+            table = formats.Tabulate()
+            table.add_columns(["Span", "Start", "Duration", "Details"])
+
+            for span in trace.spans:
+                depth = depths[span.parent_id] + 1 if span.parent_id in depths else 0
+                depths[span.span_id] = depth
+
+                details = " ".join(f"{key}={value}" for key, value in span.attributes.items() if value is not None)
+                if span.error:
+                    details = f"{details} error={span.error}".strip()
+
+                table.add_row([
+                    f"{'  '*depth}{span.name}",
+                    f"+{int(span.offset*1000)}ms",
+                    f"{int(span.duration*1000)}ms" if span.duration is not None else "running",
+                    details if len(details) <= 60 else f"{details[:57]}..."
+                ])
+
+            results = f"{trace.name} ({trace.trace_id}) took {int(trace.duration*1000)}ms\n\n{table}"
+            try:
+                return await ctx.send(f"```\n{results}```")
+            except discord.HTTPException:
+                return await ctx.send(file=discord.File(io.BytesIO(results.encode("utf-8")), filename="trace.txt"))
+
+        traces = tracer.slowest(15)
+        if not traces:
+            return await ctx.send("No traces have been recorded yet")
+
+        table = formats.Tabulate()
+        table.add_columns(["Trace", "Command", "Duration", "Spans", "When"])
+        table.add_rows([
+            (
+                trace.trace_id[:8],
+                trace.name,
+                f"{int(trace.duration*1000)}ms",
+                len(trace.spans),
+                humanize.naturaltime(trace.root.started_at.replace(tzinfo=None), when=datetime.datetime.utcnow())
+            )
+            for trace in traces
+        ])
+
+        await ctx.send(f"```\n{table}```")
+
     @commands.command(description="Displays operating system stats", aliases=["system", "health"])
     async def process(self, ctx):
         em = discord.Embed(title="Process", color=0x96c8da)
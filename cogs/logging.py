@@ -33,6 +33,7 @@ class MessageLog:
                    SET channel_id=$2;
                 """
         await self.cog.bot.db.execute(query, self.guild_id, self.channel_id)
+        self.cog.get_message_log.invalidate(self, self.guild_id)
 
 
 class EditedView(discord.ui.View):
@@ -50,7 +51,7 @@ class Logging(commands.Cog):
     def cog_check(self, ctx):
         return ctx.guild is not None and ctx.guild.id in self.bot.config.logging_guild_ids
 
-    @cache.cache()
+    @cache.cache(max_size=1024)
     async def get_message_log(self, guild_id):
         query = """SELECT *
                    FROM message_logs
@@ -287,6 +287,7 @@ class Meta(commands.Cog):
 
         prefixes.append(prefix)
         await self.bot.prefixes.add(ctx.guild.id, prefixes)
+        self.bot.invalidate_prefixes(ctx.guild.id)
 
         await ctx.send(f"Added the prefix `{prefix}`.")
 
@@ -300,6 +301,7 @@ class Meta(commands.Cog):
 
         prefixes.remove(prefix)
         await self.bot.prefixes.add(ctx.guild.id, prefixes)
+        self.bot.invalidate_prefixes(ctx.guild.id)
 
         await ctx.send(f"Removed the prefix `{prefix}`.")
 
@@ -316,6 +318,7 @@ class Meta(commands.Cog):
 
         prefixes = [prefix] + prefixes
         await self.bot.prefixes.add(ctx.guild.id, prefixes)
+        self.bot.invalidate_prefixes(ctx.guild.id)
 
         await ctx.send(f"Set `{prefix}` as the default prefix.")
 
@@ -328,6 +331,7 @@ class Meta(commands.Cog):
             return await ctx.send("Aborting")
 
         await self.bot.prefixes.add(ctx.guild.id, [])
+        self.bot.invalidate_prefixes(ctx.guild.id)
         await ctx.send(f"Removed all prefixes.")
 
     @prefix.command(name="reset", description="Resets the server prefixes")
@@ -339,11 +343,12 @@ class Meta(commands.Cog):
             return await ctx.send("Aborting")
 
         await self.bot.prefixes.remove(ctx.guild.id)
+        self.bot.invalidate_prefixes(ctx.guild.id)
         await ctx.send(f"Reset prefixes to default prefixes.")
 
     @prefix.command(name="list", description="Shows the server prefies")
     async def prefix_list(self, ctx):
-        prefixes = await self.bot.get_prefix(ctx.message)
+        prefixes = list(self.bot.get_prefix_matcher(ctx.guild.id if ctx.guild else None).prefixes)
         prefixes.pop(0)
 
         em = discord.Embed(title="Prefixes", description="\n".join(f"- {prefix}" for prefix in prefixes), color=0x96c8da)
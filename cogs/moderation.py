@@ -8,7 +8,7 @@ import typing
 import discord
 from discord.ext import commands
 
-from .utils import cache, formats, human_time, menus
+from .utils import cache, db, formats, human_time, menus
 
 class BannedMember(commands.Converter):
     async def convert(self, ctx, arg):
@@ -245,11 +245,18 @@ class SpamDetector:
         return spammer
 
 class Moderation(commands.Cog):
+    guild_config_query = """SELECT *
+                            FROM guild_config
+                            WHERE guild_config.guild_id=$1;
+                         """
+    db.register("moderation.get_guild_config", guild_config_query)
+
     def __init__(self, bot):
         self.bot = bot
         self.emoji = ":police_car:"
 
         self.spam_detectors = {}
+        self.spam_detections = self.bot.metrics.counter("spam_detections_total", "Members caught by spam prevention, by the action taken", ["action"])
 
     @commands.command(name="kick", description="Kick a member from the server")
     @commands.bot_has_permissions(kick_members=True)
@@ -307,7 +314,7 @@ class Moderation(commands.Cog):
         timers = self.bot.get_cog("Timers")
         if not timers:
             return await ctx.send(":x: This feature is temporarily unavailable")
-        await timers.create_timer("tempban", [ctx.guild.id, user.id], expires_at, created_at)
+        await timers.create_timer("tempban", [ctx.guild.id, user.id], expires_at, created_at, guild_id=ctx.guild.id)
 
         try:
             await user.send(f"Just so you know, you've been banned from {ctx.guild.name} until <t:{int(expires_at.replace(tzinfo=datetime.timezone.utc).timestamp())}:F>")
@@ -551,7 +558,7 @@ class Moderation(commands.Cog):
         timers = self.bot.get_cog("Timers")
         if not timers:
             return await ctx.send(":x: This feature is temporarily unavailable")
-        await timers.create_timer("tempmute", [ctx.guild.id, user.id], expires_at, created_at)
+        await timers.create_timer("tempmute", [ctx.guild.id, user.id], expires_at, created_at, guild_id=ctx.guild.id)
 
         await user.add_roles(config.mute_role, reason=reason)
         await ctx.send(f":white_check_mark: Temporarily muted `{user}` for `{delta}`")
@@ -586,7 +593,7 @@ class Moderation(commands.Cog):
         if not result:
             return await ctx.send("Aborting")
 
-        await timers.create_timer("tempmute", [ctx.guild.id, ctx.author.id], expires_at, created_at)
+        await timers.create_timer("tempmute", [ctx.guild.id, ctx.author.id], expires_at, created_at, guild_id=ctx.guild.id)
 
         await ctx.author.add_roles(config.mute_role, reason=f"Selfmute for {human_delta}")
         await ctx.send(f":white_check_mark: You have been muted for `{human_delta}`")
@@ -791,13 +798,9 @@ class Moderation(commands.Cog):
         deleted = await method(ctx, limit+1)
         await ctx.send(f":white_check_mark: Deleted {formats.plural(len(deleted)):message}", delete_after=5)
 
-    @cache.cache()
+    @cache.cache(max_size=1024)
     async def get_guild_config(self, guild_id):
-        query = """SELECT *
-                   FROM guild_config
-                   WHERE guild_config.guild_id=$1;
-                """
-        record = await self.bot.db.fetchrow(query, guild_id)
+        record = await self.bot.db.fetchrow(self.guild_config_query, guild_id)
 
         if not record:
             record =  {
@@ -879,13 +882,14 @@ class Moderation(commands.Cog):
         if detector.is_spamming(message):
             spammer = detector.get_spammer(message.author)
             action = self.get_spam_action(config, spammer)
+            self.spam_detections.inc(action=action.name.lower())
 
             if action == SpamAction.MUTE:
                 timers = self.bot.get_cog("Timers")
                 if timers:
                     expires_at = datetime.datetime.utcnow()+spammer.mute_time
                     created_at = datetime.datetime.utcnow()
-                    await timers.create_timer("tempmute", [message.guild.id, message.author.id], expires_at, created_at)
+                    await timers.create_timer("tempmute", [message.guild.id, message.author.id], expires_at, created_at, guild_id=message.guild.id)
                     await message.author.add_roles(config.mute_role, reason=f"Automatic mute for spamming ({human_time.timedelta(spammer.mute_time)})")
             else:
                 await message.author.ban(reason=f"Automatic ban for spamming")
@@ -1,12 +1,14 @@
 import asyncio
+import contextlib
 import datetime
 import functools
 import io
-import itertools
 import logging
+import math
 import os
 import random
 import re
+import shlex
 import time
 import typing
 import urllib
@@ -14,9 +16,10 @@ import urllib
 import discord
 import humanize
 import yt_dlp
+from discord import app_commands
 from discord.ext import commands, menus
 
-from .utils import errors, formats, human_time, spotify
+from .utils import blocklist, cache, db, errors, formats, human_time, songcache, spotify, ytdl
 
 log = logging.getLogger("robo_coder.music")
 
@@ -104,7 +107,7 @@ class QueueNextButton(discord.ui.Button):
         self.parent = parent
 
     async def callback(self, interaction):
-        if self.parent.current_page == len(self.parent.pages) - 1:
+        if self.parent.current_page >= self.parent.page_count - 1:
             return await interaction.response.defer()
 
         self.parent.current_page += 1
@@ -114,34 +117,36 @@ class QueueView(discord.ui.View):
     def __init__(self, player):
         super().__init__()
 
+        # Pages are read from the queue as they're shown instead of copying the whole queue up front
+        self.player = player
         self.per_page = 10
         self.current_page = 0
-        self.pages = []
 
-        for page in range(0, len(player.queue), self.per_page):
-            self.pages.append(player.queue[page:page + self.per_page])
-
-        self.queue_duration = Song.parse_duration(sum([song.total_seconds for song in player.queue]))
-        self.queue_length = len(player.queue)
-        self.is_looping = player.looping_queue
-
-        if len(self.pages) > 1:
+        if self.page_count > 1:
             self.add_item(QueueBackButton(self))
             self.add_item(QueueNextButton(self))
 
+    @property
+    def page_count(self):
+        return max(math.ceil(len(self.player.queue) / self.per_page), 1)
+
     @property
     def embed(self):
-        songs = self.pages[self.current_page]
+        queue = self.player.queue
+
+        # The queue might have gotten shorter since this page was opened
+        self.current_page = min(self.current_page, self.page_count - 1)
         offset = self.current_page * self.per_page
+        songs = queue[offset:offset + self.per_page]
 
-        em = discord.Embed(title=f"Queue {'(:repeat: Looping)' if self.is_looping else ''}", description="", color=0x66FFCC)
+        em = discord.Embed(title=f"Queue {'(:repeat: Looping)' if self.player.looping_queue else ''}", description="", color=0x66FFCC)
 
         for i, song in enumerate(songs, start=offset):
-            em.description += f"\n{i+1}. [{song.title}]({song.url}) `{song.duration}` - {song.requester.mention}"
+            em.description += f"\n{i+1}. [{song.title}]({song.url}) `{song.duration}` - <@{song.requester_id}>"
 
-        em.description += f"\n\n{self.queue_duration} total"
+        em.description += f"\n\n{Song.parse_duration(queue.total_seconds)} total"
 
-        em.set_footer(text=f"{self.queue_length} songs | Page {self.current_page+1}/{(int(self.queue_length/10))+1}")  
+        em.set_footer(text=f"{len(queue)} songs | Page {self.current_page+1}/{self.page_count}")
 
         return em
 
@@ -155,15 +160,40 @@ class MusicVoiceClient(discord.VoiceClient):
             await player.cleanup()
 
 class MusicAudioSource(discord.FFmpegPCMAudio):
-    def __init__(self, filename, *, speed=1, start=0):
+    def __init__(self, filename, *, speed=1, start=0, stream=False, headers=None):
+        before_options = []
+        if stream:
+            # Remote streams drop every so often, so FFmpeg should pick up where it left off
+            before_options.append("-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5")
+            if headers:
+                header_lines = "".join(f"{key}: {value}\r\n" for key, value in headers.items())
+                before_options.append(f"-headers {shlex.quote(header_lines)}")
+        if start != 0:
+            before_options.append(f"-ss {start}")
+
         super().__init__(
             filename,
-            before_options=f"-ss {start}" if start != 0 else None,
+            before_options=" ".join(before_options) or None,
             options=f"-vn -filter:a atempo='{speed}'"  if speed != 1 else "-vn"
         )
 
         self.position = start * 1000
 
+    @classmethod
+    def from_song(cls, song, *, speed=1, start=0):
+        # Plays the downloaded file if there is one, otherwise the stream while the file is still downloading
+        if os.path.exists(song.filename) or not song.can_stream:
+            return cls(song.filename, speed=speed, start=start)
+
+        return cls(song.stream_url, speed=speed, start=start, stream=True, headers=song.http_headers)
+
+class OpusPassthroughSource(discord.FFmpegOpusAudio):
+    # Sends the packets from a pre-encoded file as they are, so there's no decoding, volume or encoding to do
+    def __init__(self, filename, *, start=0):
+        super().__init__(filename, codec="copy", before_options=f"-ss {start}" if start != 0 else None)
+
+        self.position = start * 1000
+
     def read(self):
         ret = super().read()
 
@@ -172,16 +202,114 @@ class MusicAudioSource(discord.FFmpegPCMAudio):
 
         return ret
 
+class SongContext:
+    # Enough of a context for Song to download in the background, after the command that queued it is gone
+    __slots__ = ("bot", "author")
+
+    def __init__(self, bot, author):
+        self.bot = bot
+        self.author = author
+
+class Prefetcher:
+    """Makes sure the current song and the next few in the queue are loaded and downloaded."""
+
+    __slots__ = ("player", "lookahead", "tasks", "_task")
+
+    def __init__(self, player, *, lookahead=3):
+        self.player = player
+        self.lookahead = lookahead
+
+        # By (extractor, song ID), since the same song is a QueueEntry in the queue and a Song once it's playing
+        self.tasks = {}
+        self._task = player.bot.loop.create_task(self.run())
+
+    async def run(self):
+        queue = self.player.queue
+        while True:
+            await queue.changed.wait()
+            queue.changed.clear()
+            self.update()
+
+    def update(self):
+        upcoming = {}
+        if self.player.now:
+            upcoming[self.player.now.key] = self.player.now
+        for entry in self.player.queue[:self.lookahead]:
+            upcoming.setdefault(entry.key, entry)
+
+        # Songs that were removed, skipped past or stopped don't need their downloads anymore
+        for key, task in list(self.tasks.items()):
+            if key not in upcoming:
+                task.cancel()
+                del self.tasks[key]
+
+        for key, item in upcoming.items():
+            if key in self.tasks:
+                continue
+
+            loaded = isinstance(item, Song) or item.song is not None
+            if not loaded or item.filename not in self.player.bot.song_cache:
+                self.tasks[key] = self.start(item)
+
+    def start(self, item):
+        log.info("PREFETCHER: Preparing %s ahead of time for %s.", item.title, self.player)
+        task = self.player.bot.loop.create_task(self.download(item))
+        task.add_done_callback(self.finished)
+        return task
+
+    async def download(self, item):
+        song = item if isinstance(item, Song) else await item.load(self.player, keep=True)
+
+        if song.filename not in self.player.bot.song_cache:
+            # Songs that were streamed are already being cached, so wait on that instead of downloading them twice
+            task = Song.caching.get(song.key)
+            if task is not None:
+                new_song = await asyncio.shield(task)
+            else:
+                new_song = await Song.confirm_download(SongContext(self.player.bot, song.requester), song)
+
+            # The queue holds this song, so update it instead of replacing it
+            song.filename = item.filename = new_song.filename
+
+        return song
+
+    def finished(self, task):
+        if not task.cancelled() and task.exception() is not None:
+            log.warning("PREFETCHER: Failed to download a song ahead of time for %s.", self.player, exc_info=task.exception())
+
+    async def ensure(self, song):
+        # Waits for the song's file, downloading it now if it wasn't prefetched
+        task = self.tasks.get(song.key)
+        if task is None or task.done():
+            # Even a file that was prefetched could have been evicted since, so the disk gets the final say
+            if os.path.exists(song.filename):
+                return
+
+            # Another process might have evicted it without us hearing about it yet
+            self.player.bot.song_cache.discard(song.filename, notify=False)
+            task = self.tasks[song.key] = self.start(song)
+
+        await asyncio.shield(task)
+
+    def close(self):
+        self._task.cancel()
+        for task in self.tasks.values():
+            task.cancel()
+        self.tasks.clear()
+
 class MusicPlayer:
     __slots__ = ("voice", "text_channel", "queue", "_event", "now",
                  "notifications", "looping", "looping_queue",
-                 "_volume", "_speed", "_is_skip", "loop")
+                 "_volume", "_volume_scale", "_speed", "_is_skip", "loop", "prefetcher")
+
+    # Set by the cog
+    songs_played = None
 
     def __init__(self, voice, text_channel):
         self.voice = voice
         self.text_channel = text_channel
 
-        self.queue = Queue()
+        self.queue = Queue(expanded=getattr(self.bot.config, "prefetch_songs", 3))
         self._event = asyncio.Event()
 
         self.now = None
@@ -189,11 +317,13 @@ class MusicPlayer:
         self.looping = False
         self.looping_queue = False
 
-        self._volume = .5
+        self._volume = Song.encoded_volume
+        self._volume_scale = 1
         self._speed = 1
         self._is_skip = False
 
         self.loop = self.bot.loop.create_task(self.player_loop())
+        self.prefetcher = Prefetcher(self, lookahead=getattr(self.bot.config, "prefetch_songs", 3))
 
     def __str__(self):
         return f"channel ID {self.channel.id} (guild ID {self.guild.id})"
@@ -220,31 +350,54 @@ class MusicPlayer:
 
     @volume.setter
     def volume(self, value):
-        if self.voice.source:
-            self.voice.source.volume = value
-
         self._volume = value
 
+        if isinstance(self.voice.source, discord.PCMVolumeTransformer):
+            self.voice.source.volume = value * self._volume_scale
+        elif self.voice.source:
+            # Passthrough can't change the volume, so switch to decoding from where we are
+            self.replace_source(self.position)
+
     @property
     def speed(self):
         return self._speed
 
     @speed.setter
     def speed(self, value):
-        source = MusicAudioSource(self.now.filename, speed=value, start=self.position)
-        self.voice.source = discord.PCMVolumeTransformer(source, self._volume)
-
+        position = self.position
         self._speed = value
+        self.replace_source(position)
 
     @property
     def position(self):
         if self.voice.source:
-            return (self.voice.source.original.position / 1000) * self._speed
+            source = getattr(self.voice.source, "original", self.voice.source)
+            return (source.position / 1000) * self._speed
 
     @position.setter
     def position(self, value):
-        source = MusicAudioSource(self.now.filename, speed=self._speed, start=value)
-        self.voice.source = discord.PCMVolumeTransformer(source, self._volume)
+        self.replace_source(value)
+
+    def create_source(self, *, start=0):
+        song = self.now
+        pre_encoded = Song.is_pre_encoded(song.filename) and (os.path.exists(song.filename) or not song.can_stream)
+
+        # Pre-encoded files already have the default volume applied, so at the defaults nothing needs to be done to them
+        if pre_encoded and self._speed == 1 and self._volume == Song.encoded_volume:
+            return OpusPassthroughSource(song.filename, start=start)
+
+        self._volume_scale = 1 / Song.encoded_volume if pre_encoded else 1
+        source = MusicAudioSource.from_song(song, speed=self._speed, start=start)
+        return discord.PCMVolumeTransformer(source, self._volume * self._volume_scale)
+
+    def replace_source(self, start):
+        source = self.create_source(start=start)
+
+        # The voice client only makes an encoder when play() is called with a PCM source
+        if not source.is_opus() and self.voice.encoder is discord.utils.MISSING:
+            self.voice.encoder = discord.opus.Encoder()
+
+        self.voice.source = source
 
     @property
     def is_playing(self):
@@ -272,7 +425,7 @@ class MusicPlayer:
         em.add_field(name="Duration", value=f"{Song.parse_timestamp_duration(self.position)}/{self.now.timestamp_duration} `{self.bar}`", inline=False)
         em.add_field(name="Url", value=f"[Click]({self.now.url})")
         em.add_field(name="Uploader", value=f"[{self.now.uploader}]({self.now.uploader_url})")
-        em.add_field(name="Requester", value=f"{self.now.requester.mention}")
+        em.add_field(name="Requester", value=f"<@{self.now.requester.id}>")
         return em
 
     async def player_loop(self):
@@ -285,7 +438,7 @@ class MusicPlayer:
                     queue_is_empty = self.queue.empty()
 
                     try:
-                        self.now = await asyncio.wait_for(self.queue.get(), timeout=180)
+                        entry = await asyncio.wait_for(self.queue.get(), timeout=180)
                     except asyncio.TimeoutError:
                         log.info("PLAYER: Timed out while getting song from queue for %s. Cleaning up player.", self)
                         self.stop()
@@ -296,22 +449,41 @@ class MusicPlayer:
 
                         return
 
+                    try:
+                        self.now = await entry.load(self)
+                    except errors.SongError as exc:
+                        log.warning("PLAYER: Couldn't load %s for %s. Skipping it.", entry.title, self, exc_info=exc)
+                        await self.text_channel.send(f":warning: Couldn't find `{entry.title}` again, skipping it")
+                        continue
+
                 if not self.voice.is_connected():
                     # The player is disconnected, wait until it reconnects to a voice channel
                     log.info("PLAYER: Waiting until bot is connected to play music in %s.", self)
                     await self.bot.loop.run_in_executor(None, self.voice._connected.wait)
 
-                log.info("PLAYER: Playing a song in %s.", self)
-                source = MusicAudioSource(self.now.filename, speed=self._speed)
-                transformed = discord.PCMVolumeTransformer(source, self._volume)
+                # Usually the prefetcher already has the file, otherwise this is where we wait for it.
+                # Songs that were just resolved can be streamed while they download instead.
+                self.prefetcher.update()
+                if not self.now.can_stream:
+                    try:
+                        await self.prefetcher.ensure(self.now)
+                    except errors.SongError as exc:
+                        log.warning("PLAYER: Couldn't download %s for %s. Skipping it.", self.now.title, self, exc_info=exc)
+                        await self.text_channel.send(f":warning: Couldn't download `{self.now.title}`, skipping it")
+                        self.now = None
+                        continue
 
-                self.voice.play(transformed, after=self.after_song)
+                log.info("PLAYER: Playing a song in %s.", self)
+                source = self.create_source()
+                self.voice.play(source, after=self.after_song)
+                self.songs_played.inc()
 
                 query = """UPDATE songs
                            SET plays = plays + 1
                            WHERE songs.id=$1;
                         """
                 await self.bot.db.execute(query, self.now.id)
+                self.bot.song_cache.played(self.now.filename)
 
                 if self.notifications or queue_is_empty:
                     if self.now.interaction and not self.now.interaction.is_expired():
@@ -372,6 +544,7 @@ class MusicPlayer:
             self.loop.cancel()
 
         self.stop()
+        self.prefetcher.close()
 
         log.info("Deleting player for %s", self)
         if self.guild.id in self.bot.players:
@@ -385,10 +558,10 @@ class Song:
                  "uploader", "uploader_url", "date", "total_seconds", "upload_date",
                  "title", "thumbnail", "description", "duration", "timestamp_duration",
                  "tags", "url", "views", "likes", "dislikes",
-                 "stream_url", "id", "plays", "created_at",
-                 "updated_at")
+                 "stream_url", "http_headers", "resolved_at", "id", "plays",
+                 "created_at", "updated_at")
 
-    ytdl = yt_dlp.YoutubeDL({
+    ytdl_options = {
         "format": "bestaudio/best",
         "extractaudio": True,
         "audioformat": "mp3",
@@ -402,7 +575,13 @@ class Song:
         "no_warnings": True,
         "default_search": "auto",
         "source_address": "0.0.0.0",
-    })
+    }
+
+    # Only used here for working out filenames, anything that touches the network goes through the worker pool
+    ytdl = yt_dlp.YoutubeDL(ytdl_options)
+
+    # The yt-dlp worker processes. Set by the cog.
+    workers = None
 
     def __init__(self, ctx, *, data, filename=None):
         self._data = data
@@ -428,12 +607,27 @@ class Song:
         self.likes = data.get("like_count")
         self.dislikes = data.get("dislike_count")
         self.stream_url = data.get("url")
+        self.http_headers = data.get("http_headers")
+        self.resolved_at = None
 
         self.id = None
         self.plays = None
         self.created_at = None
         self.updated_at = None
 
+    # The only parts of yt-dlp's info that get read, everything else (formats, subtitles, etc.) isn't worth storing.
+    # Keep this in sync with the migration in schema.sql.
+    stored_fields = ("id", "extractor", "title", "uploader", "uploader_url", "upload_date", "duration", "thumbnail",
+                     "description", "tags", "webpage_url", "view_count", "like_count", "dislike_count")
+
+    @property
+    def key(self):
+        return (self.extractor, self.song_id)
+
+    @property
+    def stored_data(self):
+        return {key: self._data[key] for key in self.stored_fields if key in self._data}
+
     @property
     def embed(self):
         em = discord.Embed(title=self.title, color=0x66FFCC)
@@ -441,61 +635,175 @@ class Song:
         em.add_field(name="Duration", value=str(self.timestamp_duration))
         em.add_field(name="Url", value=f"[Click]({self.url})")
         em.add_field(name="Uploader", value=f"[{self.uploader}]({self.uploader_url})")
-        em.add_field(name="Requester", value=f"{self.requester.mention}")
+        em.add_field(name="Requester", value=f"<@{self.requester.id}>")
         return em
 
+    # Stream URLs expire after a few hours, so only ones that were just resolved get played directly
+    stream_lifetime = 3600
+
+    @property
+    def can_stream(self):
+        return self.stream_url is not None and self.resolved_at is not None and time.monotonic() - self.resolved_at < self.stream_lifetime
+
+    # Normalised searches to song row IDs, so repeat searches for a song only need to fetch its row
+    aliases = cache.LRUCache(max_size=4096, ttl=86400)
+
+    # How long a search is saved in the database for
+    alias_lifetime = datetime.timedelta(days=30)
+
+    @staticmethod
+    def normalise_search(search):
+        search = " ".join(search.split())
+
+        # Searches for text aren't case sensitive, but URLs and IDs are
+        if " " in search:
+            return search.casefold()
+        return search
+
+    # What from_record reads. The title, uploader, duration and url columns are copies of what's in data for searching,
+    # so they're left out, and anything that doesn't need a full Song should select only the columns it uses instead.
+    record_columns = "songs.id, songs.song_id, songs.extractor, songs.filename, songs.plays, songs.data, songs.created_at, songs.updated_at"
+
+    # The queries behind from_query, which runs for nearly every song that's played
+    by_id_query = f"""SELECT {record_columns}
+                      FROM songs
+                      WHERE songs.id=$1;
+                   """
+    db.register("songs.from_query.by_id", by_id_query)
+
+    # A saved search, or else a song with the search as its YouTube ID
+    lookup_query = f"""WITH found AS (
+                           SELECT {record_columns}, 0 AS priority
+                           FROM song_searches
+                           INNER JOIN songs ON song_searches.song_id=songs.id
+                           WHERE song_searches.search=$1 AND song_searches.expires_at > $3
+                           UNION ALL
+                           SELECT {record_columns}, 1 AS priority
+                           FROM songs
+                           WHERE songs.song_id=$2 AND songs.extractor='youtube'
+                           ORDER BY priority
+                           LIMIT 1
+                       ), alias AS (
+                           INSERT INTO song_searches (search, song_id, expires_at)
+                           SELECT $1, found.id, $4
+                           FROM found
+                           WHERE found.priority=1
+                           ON CONFLICT (search) DO UPDATE
+                           SET song_id=EXCLUDED.song_id, expires_at=EXCLUDED.expires_at
+                       )
+                       SELECT *
+                       FROM found;
+                    """
+    db.register("songs.from_query.lookup", lookup_query)
+
+    # Looks up a song that was just resolved and saves the search for it
+    resolved_query = f"""WITH found AS (
+                             SELECT {record_columns}
+                             FROM songs
+                             WHERE songs.song_id=$2 AND songs.extractor=$3
+                         ), alias AS (
+                             INSERT INTO song_searches (search, song_id, expires_at)
+                             SELECT $1, found.id, $4
+                             FROM found
+                             ON CONFLICT (search) DO UPDATE
+                             SET song_id=EXCLUDED.song_id, expires_at=EXCLUDED.expires_at
+                         )
+                         SELECT *
+                         FROM found;
+                      """
+    db.register("songs.from_query.resolved", resolved_query)
+
+    # What autocomplete suggestions from the library look like, followed by the song's row ID
+    library_prefix = "library:"
+
     @classmethod
     async def from_query(cls, ctx, search,  *, search_only=False):
-        # Check if the search and result is already cached in the database
-        possible_song = await cls.from_alias(ctx, search)
-        if possible_song:
-            return await cls.confirm_download(ctx, possible_song)
-
-        # This checks to see if the query is a youtube song name or id that is already cached in the database and returns the result if any is found
-        if not search_only:
-            youtube_id = cls.parse_youtube_id(search) or search
-            query = """SELECT *
-                    FROM songs
-                    WHERE songs.song_id=$1 AND songs.extractor='youtube';
-                    """
-            record = await ctx.bot.db.fetchrow(query, youtube_id)
+        if search.startswith(cls.library_prefix) and search[len(cls.library_prefix):].isdigit():
+            record = await ctx.bot.db.fetchrow(cls.by_id_query, int(search[len(cls.library_prefix):]))
+            if not record:
+                raise errors.SongError("That song isn't in my library anymore")
+
+            return await cls.confirm_download(ctx, cls.from_record(record, ctx))
+
+        search = cls.normalise_search(search)
+
+        try:
+            song_id = cls.aliases.get(search)
+        except KeyError:
+            pass
+        else:
+            record = await ctx.bot.db.fetchrow(cls.by_id_query, song_id)
             if record:
-                await cls.create_alias(ctx, search, record["id"])
-                song = cls.from_record(record, ctx)
-                return await cls.confirm_download(ctx, song)
+                return await cls.confirm_download(ctx, cls.from_record(record, ctx))
+
+            # The song was deleted
+            cls.aliases.pop(search)
+
+        # Check the search against the saved searches and, unless this is only a search, against the YouTube IDs of the songs we have.
+        # A match by ID is saved as a search in the same statement.
+        youtube_id = None if search_only else cls.parse_youtube_id(search) or search
+        now = datetime.datetime.utcnow()
+        record = await ctx.bot.db.fetchrow(cls.lookup_query, search, youtube_id, now, now + cls.alias_lifetime)
+        if record:
+            cls.aliases.set(search, record["id"])
+            return await cls.confirm_download(ctx, cls.from_record(record, ctx))
 
         # Resolve the query into a full Song, so we can search the database
         song = await cls.resolve_query(ctx, search, ytsearch=search_only)
-        query = """SELECT *
-                   FROM songs
-                   WHERE songs.song_id=$1 AND songs.extractor=$2;
-                """
-        record = await ctx.bot.db.fetchrow(query, song.song_id, song.extractor)
+        record = await ctx.bot.db.fetchrow(cls.resolved_query, search, song.song_id, song.extractor, now + cls.alias_lifetime)
         if record:
-            await cls.create_alias(ctx, search, record["id"])
-            song = cls.from_record(record, ctx)
-            return await cls.confirm_download(ctx, song)
+            cls.aliases.set(search, record["id"])
+            return await cls.confirm_download(ctx, cls.from_record(record, ctx))
+
+        # We shouldn't get here unless the song isn't in the database.
+        # It can start playing from the stream right away while the file is cached in the background.
+        cls.cache_in_background(SongContext(ctx.bot, ctx.author), song, search)
+        return song
 
-        # We shouldn't get here unless the song isn't in the database
-        song = await cls.download_song(ctx, song, extract_info=False)
-        data = song._data
+    # Songs being downloaded and added to the database in the background, by (extractor, song ID)
+    caching = {}
+
+    @classmethod
+    def cache_in_background(cls, ctx, song, search):
+        key = song.key
+        task = cls.caching.get(key)
+        if task is None:
+            task = cls.caching[key] = ctx.bot.loop.create_task(cls.cache_song(ctx, song, search))
+            task.add_done_callback(functools.partial(cls._cached, key))
+
+        return task
+
+    @classmethod
+    def _cached(cls, key, task):
+        del cls.caching[key]
+        if not task.cancelled() and task.exception() is not None:
+            log.warning("Failed to cache song %s from %s in the background.", key[1], key[0], exc_info=task.exception())
 
-        # Cache the song and search in the database
-        query = """INSERT INTO songs (song_id, title, filename, extractor, plays, data)
-                   VALUES ($1, $2, $3, $4, $5, $6)
+    @classmethod
+    async def cache_song(cls, ctx, song, search):
+        # yt-dlp writes to a .part file and renames it when it's done,
+        # so the file only shows up in songs/ once it's complete
+        downloaded = await cls.download_song(ctx, song, extract_info=False)
+        song.filename = downloaded.filename
+
+        # The song is only added to the database once its file exists
+        query = """INSERT INTO songs (song_id, title, uploader, duration, url, filename, extractor, plays, data)
+                   VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9)
+                   ON CONFLICT (song_id, extractor) DO UPDATE
+                   SET filename=EXCLUDED.filename
                    RETURNING id;
                 """
-        value = await ctx.bot.db.fetchval(query, song.song_id, song.title, song.filename, song.extractor, 0, data)
-        await cls.create_alias(ctx, search, value)
+        song.id = await ctx.bot.db.fetchval(query, song.song_id, song.title, song.uploader, song.total_seconds, song.url, song.filename, song.extractor, 0, song.stored_data)
+        if search is not None:
+            await cls.create_alias(ctx, search, song.id)
 
-        return cls(ctx, data=data, filename=song.filename)
+        return song
 
     @classmethod
     async def resolve_query(cls, ctx, search, *, ytsearch=False):
-        partial = functools.partial(cls.ytdl.extract_info, f"{'ytsearch:' if ytsearch else ''}{search}", download=False)
         try:
-            info = await ctx.bot.loop.run_in_executor(None, partial)
-        except yt_dlp.DownloadError as exc:
+            info = await cls.workers.run("extract_info", f"{'ytsearch:' if ytsearch else ''}{search}", download=False)
+        except (yt_dlp.DownloadError, ytdl.WorkerError) as exc:
             raise errors.SongError(str(exc)) from exc
 
         if not info:
@@ -505,15 +813,92 @@ class Song:
             if not entries:
                 raise errors.SongError(f"I couldn't find any results for `{search}`")
             info = entries[0]
-        return cls(ctx, data=info, filename=cls.ytdl.prepare_filename(info))
+
+        song = cls(ctx, data=info, filename=cls.ytdl.prepare_filename(info))
+        song.resolved_at = time.monotonic()
+        return song
+
+    # Caps how many downloads run at once across every player. Set by the cog from config.
+    downloads = asyncio.Semaphore(3)
+
+    # Download metrics. Set by the cog.
+    downloads_in_progress = None
+    download_duration = None
+
+    # Whether downloads are re-encoded to Ogg Opus for passthrough playback. Set by the cog from config.
+    opus_cache = True
+
+    # The player's default volume, which pre-encoded files have applied already
+    encoded_volume = .5
+
+    @staticmethod
+    def is_pre_encoded(filename):
+        # Named so they can't be mistaken for an .opus file straight from yt-dlp, which wouldn't have the volume applied
+        return filename.endswith(".encoded.opus")
+
+    @classmethod
+    async def encode_opus(cls, filename):
+        output = f"{os.path.splitext(filename)[0]}.encoded.opus"
+        temp = f"{output}.part"
+
+        process = await asyncio.create_subprocess_exec(
+            "ffmpeg", "-y", "-loglevel", "error", "-i", filename, "-vn", "-map_metadata", "-1",
+            "-af", f"volume={cls.encoded_volume}", "-c:a", "libopus", "-b:a", "128k", "-ar", "48000", "-ac", "2",
+            "-fec", "true", "-packet_loss", "15", "-f", "ogg", temp,
+            stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE
+        )
+
+        try:
+            _, stderr = await process.communicate()
+        except asyncio.CancelledError:
+            process.kill()
+            await process.wait()
+            cls._remove_file(temp)
+            raise
+
+        if process.returncode != 0:
+            # The original file still plays fine, just through the slower path
+            log.warning("Failed to encode %s to Opus: %s", filename, stderr.decode(errors="replace").strip())
+            cls._remove_file(temp)
+            return filename
+
+        os.replace(temp, output)
+        cls._remove_file(filename)
+        return output
+
+    @staticmethod
+    def _remove_file(filename):
+        try:
+            os.remove(filename)
+        except FileNotFoundError:
+            pass
 
     @classmethod
     async def download_song(cls, ctx, song, extract_info=True):
+        async with cls.downloads:
+            return await cls._timed_download(ctx, song, extract_info=extract_info)
+
+    @classmethod
+    async def _timed_download(cls, ctx, song, extract_info=True):
+        cls.downloads_in_progress.inc()
+        started_at = time.perf_counter()
+        status = "failed"
+
+        try:
+            song = await cls._download_song(ctx, song, extract_info=extract_info)
+            status = "completed"
+            ctx.bot.song_cache.add(song.filename)
+            return song
+        finally:
+            cls.downloads_in_progress.dec()
+            cls.download_duration.observe(time.perf_counter() - started_at, status=status)
+
+    @classmethod
+    async def _download_song(cls, ctx, song, extract_info=True):
         if extract_info:
             try:
-                partial = functools.partial(cls.ytdl.extract_info, song.url)
-                info = await asyncio.wait_for(ctx.bot.loop.run_in_executor(None, partial), timeout=180)
-            except yt_dlp.DownloadError as exc:
+                info = await cls.workers.run("extract_info", song.url, timeout=180)
+            except (yt_dlp.DownloadError, ytdl.WorkerError) as exc:
                 raise errors.SongError(str(exc)) from exc
             except asyncio.TimeoutError as exc:
                 raise errors.SongError(f"It took too long to download `{song.url}`") from exc
@@ -526,37 +911,61 @@ class Song:
                     raise errors.SongError(f"I Couldn't find any results for `{search}`")
                 info = entries[0]
 
-            return cls(ctx, data=song._data, filename=cls.ytdl.prepare_filename(info))
+            filename = cls.ytdl.prepare_filename(info)
         else:
             try:
-                partial = functools.partial(cls.ytdl.process_info, song._data)
-                await asyncio.wait_for(ctx.bot.loop.run_in_executor(None, partial), timeout=180)
-            except yt_dlp.DownloadError as exc:
+                await cls.workers.run("process_info", song._data, timeout=180)
+            except (yt_dlp.DownloadError, ytdl.WorkerError) as exc:
                     raise errors.SongError(str(exc)) from exc
             except asyncio.TimeoutError as exc:
                     raise errors.SongError(f"It took too long to download ’{song.url}’")
 
-            return cls(ctx, data=song._data, filename=cls.ytdl.prepare_filename(song._data))
+            filename = cls.ytdl.prepare_filename(song._data)
+
+        if cls.opus_cache:
+            filename = await cls.encode_opus(filename)
+
+        return cls(ctx, data=song._data, filename=filename)
+
+    @classmethod
+    async def search_library(cls, db, search, *, limit=10, columns=None):
+        # Matches the search against titles, uploaders and saved searches using the trigram indexes, best match first.
+        # Word similarity is used so that the start of a title (like while someone is still typing) still matches.
+        query = f"""WITH matches AS (
+                        SELECT songs.id, word_similarity($1, songs.title) AS score
+                        FROM songs
+                        WHERE $1 <% songs.title
+                        UNION ALL
+                        SELECT songs.id, word_similarity($1, songs.uploader) * 0.8
+                        FROM songs
+                        WHERE $1 <% songs.uploader
+                        UNION ALL
+                        SELECT song_searches.song_id, word_similarity($1, song_searches.search) * 0.9
+                        FROM song_searches
+                        WHERE $1 <% song_searches.search
+                    )
+                    SELECT {columns or cls.record_columns}, MAX(matches.score) AS score
+                    FROM matches
+                    INNER JOIN songs ON songs.id=matches.id
+                    GROUP BY songs.id
+                    ORDER BY score DESC, songs.plays DESC
+                    LIMIT $2;
+                 """
+        return await db.fetch(query, search, limit)
 
     @classmethod
     async def from_database(cls, ctx, search):
         # Attempt to search for the song
-        query = """SELECT *
-                   FROM songs
-                   WHERE songs.title % $1
-                   ORDER BY similarity(songs.title, $1) DESC
-                   LIMIT 1;
-                """
-        record = await ctx.bot.db.fetchrow(query, search)
-        if record:
-            return cls.from_record(record, ctx)
+        records = await cls.search_library(ctx.bot.db, search, limit=1)
+        if records:
+            return cls.from_record(records[0], ctx)
 
         # We need to find a song from the database by searching
         # First check if the song is an ID from the database
-        query = """SELECT *
-                   FROM songs
-                   WHERE songs.id=$1;
-                """
+        query = f"""SELECT {cls.record_columns}
+                    FROM songs
+                    WHERE songs.id=$1;
+                 """
         if search.isdigit():
             int_search = int(search)
             record = await ctx.bot.db.fetchrow(query, int_search)
@@ -564,10 +973,10 @@ class Song:
                 return cls.from_record(record, ctx)
 
         # Attempt to get the song by youtube ID
-        query = """SELECT *
-                   FROM songs
-                   WHERE songs.song_id=$1;
-                """
+        query = f"""SELECT {cls.record_columns}
+                    FROM songs
+                    WHERE songs.song_id=$1;
+                 """
         record = await ctx.bot.db.fetchrow(query, search)
         if record:
             return cls.from_record(record, ctx)
@@ -576,39 +985,21 @@ class Song:
 
     @classmethod
     async def create_alias(cls, ctx, search, song_id):
+        # Expired searches are never looked at, so they're overwritten instead of deleted
         query = """INSERT INTO song_searches (search, song_id, expires_at)
-                   VALUES ($1, $2, $3);
+                   VALUES ($1, $2, $3)
+                   ON CONFLICT (search) DO UPDATE
+                   SET song_id=EXCLUDED.song_id, expires_at=EXCLUDED.expires_at;
                 """
-        await ctx.bot.db.execute(query, search, song_id, datetime.datetime.utcnow()+datetime.timedelta(days=30))
+        await ctx.bot.db.execute(query, search, song_id, datetime.datetime.utcnow() + cls.alias_lifetime)
+        cls.aliases.set(search, song_id)
 
     @classmethod
-    async def from_alias(cls, ctx, search):
-        query = """SELECT *
-                   FROM song_searches
-                   INNER JOIN songs ON song_searches.song_id=songs.id
-                   WHERE song_searches.search=$1;
-                """
-        record = await ctx.bot.db.fetchrow(query, search)
-        if record:
-            if datetime.datetime.utcnow() < record["expires_at"]:
-                return cls.from_record(record, ctx)
-            else:
-                await cls.delete_alias(ctx, search)
-
-    @classmethod
-    async def delete_alias(cls, ctx, search):
-        query = """DELETE FROM song_searches
-                   WHERE song_searches.search=$1;
-                """
-        await ctx.bot.db.execute(query, search)
-
-    @classmethod
-    async def playlist(cls, ctx, search, *, download=True):
+    async def playlist(cls, ctx, search):
         # Extract the songs
-        partial = functools.partial(cls.ytdl.extract_info, search, download=download)
         try:
-            info = await asyncio.wait_for(ctx.bot.loop.run_in_executor(None, partial), timeout=180)
-        except yt_dlp.DownloadError as exc:
+            info = await cls.workers.run("extract_info", search, download=False, timeout=180)
+        except (yt_dlp.DownloadError, ytdl.WorkerError) as exc:
             raise errors.SongError(str(exc)) from exc
         except asyncio.TimeoutError as exc:
             raise errors.SongError("It took to long to download that playlist")
@@ -628,6 +1019,42 @@ class Song:
 
         return songs
 
+    @classmethod
+    async def flat_playlist(cls, ctx, search):
+        # Only lists the songs, each one is resolved and downloaded once it's close to playing
+        try:
+            info = await cls.workers.run("extract_flat", search, heavy=True, timeout=120)
+        except (yt_dlp.DownloadError, ytdl.WorkerError) as exc:
+            raise errors.SongError(str(exc)) from exc
+        except asyncio.TimeoutError as exc:
+            raise errors.SongError("It took to long to load that playlist")
+        if not info:
+            raise errors.SongError(f"Couldn't find anything that matches `{search}`")
+        if "entries" not in info:
+            raise errors.SongError(f"No entries for `{search}`")
+
+        # Deleted and private videos are still listed, just without anything useful
+        songs = [cls(ctx, data=cls.flat_data(entry)) for entry in info["entries"] if entry and entry.get("id") and entry.get("url")]
+        if not songs:
+            raise errors.SongError("This playlist is empty.")
+
+        return songs
+
+    @staticmethod
+    def flat_data(entry):
+        # yt-dlp fills in the playlist's extractor and URL on flat entries, so the entry's own are used instead
+        thumbnails = entry.get("thumbnails")
+        return {
+            "id": entry["id"],
+            "extractor": (entry.get("ie_key") or "generic").lower(),
+            "title": entry.get("title") or entry["url"],
+            "duration": entry.get("duration"),
+            "uploader": entry.get("uploader") or entry.get("channel"),
+            "uploader_url": entry.get("uploader_url") or entry.get("channel_url"),
+            "thumbnail": thumbnails[-1]["url"] if thumbnails else None,
+            "webpage_url": entry["url"],
+        }
+
     @classmethod
     def from_record(cls, record, ctx):
         self = cls(ctx, data=record["data"], filename=record["filename"])
@@ -641,9 +1068,9 @@ class Song:
 
     @staticmethod
     def parse_youtube_id(url):
-        regex = re.compile("(?:https?://)?(?:www.)?(?:youtube.com|youtu.be)/(?:watch\\?v=)?([^\\s]+)")
+        regex = re.compile("(?:https?://)?(?:www\\.|m\\.)?(?:youtube\\.com/watch\\?v=|youtu\\.be/)([\\w-]{11})(?:[?&]\\S*)?")
         youtube_id = regex.fullmatch(url)
-        return youtube_id[0] if youtube_id else None
+        return youtube_id[1] if youtube_id else None
 
     @staticmethod
     def parse_duration(duration):
@@ -693,7 +1120,7 @@ class Song:
 
     @classmethod
     async def confirm_download(cls, ctx, song, extract_info=True):
-        if os.path.exists(song.filename):
+        if song.filename in ctx.bot.song_cache:
             new_song = song
         else:
             new_song = await cls.download_song(ctx, song, extract_info=extract_info)
@@ -708,18 +1135,128 @@ class Song:
 
         return new_song
 
+class QueueEntry:
+    """What the queue holds instead of a Song, which carries yt-dlp's whole info dict around.
+
+    Only the first few entries keep their Song. The rest get it back from the database
+    (or yt-dlp) once they're about to play or someone asks for the full details.
+    """
+
+    __slots__ = ("song_id", "extractor", "title", "url", "total_seconds", "filename", "requester_id", "interaction", "song", "_loading")
+
+    def __init__(self, song, *, keep=False):
+        self.song_id = song.song_id
+        self.extractor = song.extractor
+        self.title = song.title
+        self.url = song.url
+        self.total_seconds = song.total_seconds
+        self.filename = song.filename
+        self.requester_id = song.requester.id
+        self.interaction = song.interaction
+        self.song = song if keep else None
+        self._loading = None
+
+    @property
+    def key(self):
+        return (self.extractor, self.song_id)
+
+    @property
+    def duration(self):
+        return Song.parse_duration(self.total_seconds)
+
+    async def load(self, player, *, keep=False):
+        if self.song is not None:
+            return self.song
+
+        # The prefetcher and the player can both want the same entry at once, so they share one load
+        if self._loading is None:
+            self._loading = player.bot.loop.create_task(self.rehydrate(player.bot, player.guild))
+            self._loading.add_done_callback(self._loaded)
+
+        # Shielded so one of them giving up doesn't cancel it for the other
+        song = await asyncio.shield(self._loading)
+        if keep:
+            self.song = song
+        return song
+
+    def _loaded(self, task):
+        self._loading = None
+
+        # Whoever's waiting sees the error, this just keeps it from being reported as never retrieved
+        if not task.cancelled():
+            task.exception()
+
+    async def rehydrate(self, bot, guild):
+        ctx = SongContext(bot, guild.get_member(self.requester_id) or discord.Object(id=self.requester_id))
+
+        query = f"""SELECT {Song.record_columns}
+                    FROM songs
+                    WHERE songs.song_id=$1 AND songs.extractor=$2;
+                 """
+        record = await bot.db.fetchrow(query, self.song_id, self.extractor)
+        if record:
+            song = Song.from_record(record, ctx)
+        else:
+            # Never made it into the database (like songs from a playlist), so it's resolved and added from here
+            song = await Song.resolve_query(ctx, self.url)
+            Song.cache_in_background(ctx, song, None)
+
+        song.interaction = self.interaction
+        return song
+
 class Queue(asyncio.Queue):
+    def __init__(self, *args, expanded=3, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        # How many entries at the front of the queue keep their full Song
+        self.expanded = expanded
+
+        # Set whenever the contents change, so the prefetcher knows to look again
+        self.changed = asyncio.Event()
+
+    def _init(self, maxsize):
+        # Queues can be tens of thousands of songs long, so removing or moving one shouldn't mean walking all of them
+        self._queue = blocklist.BlockList()
+
+        # Kept up to date as entries come and go, so showing the queue doesn't add up every song
+        self.total_seconds = 0
+
+    def _entry(self, item, index):
+        if isinstance(item, Song):
+            return QueueEntry(item, keep=index < self.expanded)
+
+        # Entries that were moved back don't need their Song anymore
+        if index >= self.expanded:
+            item.song = None
+        return item
+
+    def _put(self, item):
+        item = self._entry(item, len(self._queue))
+        self._queue.append(item)
+        self.total_seconds += item.total_seconds
+        self.changed.set()
+
+    def _get(self):
+        item = self._queue.popleft()
+        self.total_seconds -= item.total_seconds
+        self.changed.set()
+        return item
+
     def __getitem__(self, key):
-        if isinstance(key, slice):
-            return list(itertools.islice(self._queue, key.start, key.stop, key.step))
-        else:
-            return self._queue[key]
+        return self._queue[key]
 
     def __setitem__(self, key, value):
+        value = self._entry(value, key if key >= 0 else key + len(self._queue))
+        self.total_seconds += value.total_seconds - self._queue[key].total_seconds
         self._queue[key] = value
+        self.changed.set()
+
+    def __delitem__(self, key):
+        removed = self._queue[key]
+        self.total_seconds -= sum(entry.total_seconds for entry in removed) if isinstance(key, slice) else removed.total_seconds
 
-    def __delitem__(self, key, value):
         del self._queue[key]
+        self.changed.set()
 
     def __iter__(self):
         return self._queue.__iter__()
@@ -736,14 +1273,46 @@ class Queue(asyncio.Queue):
     def __bool__(self):
         return self._queue.__bool__()
 
+    def pop(self, index):
+        item = self._queue[index]
+        del self[index]
+        return item
+
+    def skip(self, count):
+        # Takes the first count entries off the queue at once
+        if count < 0:
+            raise ValueError("Can't skip a negative number of songs")
+
+        skipped = self._queue[:count]
+        del self[:count]
+        return skipped
+
+    def extend(self, items):
+        for item in items:
+            self.put_nowait(item)
+
+    def move(self, source, destination):
+        item = self._queue.pop(source)
+        if destination < 0:
+            destination += len(self._queue) + 1
+
+        self._queue.insert(destination, self._entry(item, destination))
+        self.changed.set()
+
     def remove(self, item):
-        self._queue.remove(item)
+        del self[self._queue.index(item)]
 
     def clear(self):
         self._queue.clear()
+        self.total_seconds = 0
+        self.changed.set()
 
     def shuffle(self):
-        random.shuffle(self._queue)
+        items = list(self._queue)
+        random.shuffle(items)
+
+        self._queue = blocklist.BlockList(self._entry(item, index) for index, item in enumerate(items))
+        self.changed.set()
 
 class PositionConverter(commands.Converter):
     async def convert(self, ctx, arg):
@@ -790,6 +1359,76 @@ class Music(commands.Cog):
             client_secret=getattr(self.bot.config, "spotify_client_secret", None)
         )
 
+        Song.downloads = asyncio.Semaphore(getattr(self.bot.config, "max_concurrent_downloads", 3))
+        Song.opus_cache = getattr(self.bot.config, "opus_cache", True)
+        cache.caches["cogs.music.Song.aliases"] = Song.aliases
+
+        Song.workers = ytdl.WorkerPool(Song.ytdl_options, size=getattr(self.bot.config, "ytdl_workers", 3), metrics=self.bot.metrics)
+        Song.workers.start()
+
+        # The primary cluster is the only one that deletes files, the rest keep track of what it did
+        # and tell it which of their files are in use
+        self.bot.song_cache = songcache.SongCache(max_size=getattr(self.bot.config, "song_cache_size", None))
+        self.bot.song_cache.evicts = self.bot.is_primary
+        self.bot.song_cache.in_use = self.songs_in_use
+        self.bot.song_cache.on_change = self.broadcast_song_cache_change
+        self.reconcile_task = self.bot.loop.create_task(self.reconcile_song_cache())
+
+        self.bot.ipc.add_handler("allplayers", self.handle_allplayers)
+        self.bot.ipc.add_handler("songs_in_use", self.handle_songs_in_use)
+        MusicPlayer.songs_played = self.bot.metrics.counter("songs_played_total", "Songs started by music players")
+        Song.downloads_in_progress = self.bot.metrics.gauge("downloads_in_progress", "Songs currently being downloaded")
+        self.autocomplete_duration = self.bot.metrics.histogram("song_autocomplete_duration_seconds", "Time spent searching the library for /play suggestions", buckets=(0.001, 0.0025, 0.005, 0.01, 0.02, 0.05, 0.1, 0.25, 0.5))
+        Song.download_duration = self.bot.metrics.histogram("download_duration_seconds", "Time spent downloading songs, by outcome", ["status"], buckets=(1, 2.5, 5, 10, 20, 30, 60, 120, 180))
+        self.bot.metrics.gauge("queued_songs", "Songs waiting in music player queues", function=lambda: sum(len(player.queue) for player in self.bot.players.values()))
+        self.bot.metrics.gauge("song_cache_bytes", "Size of the downloaded songs", function=lambda: self.bot.song_cache.size)
+        self.bot.metrics.gauge("song_cache_files", "Number of downloaded songs", function=lambda: len(self.bot.song_cache))
+        self.bot.metrics.counter("song_cache_evictions_total", "Songs deleted to stay under the cache budget", function=lambda: self.bot.song_cache.evictions)
+
+    async def cog_unload(self):
+        self.reconcile_task.cancel()
+        await Song.workers.close()
+        self.bot.ipc.remove_handler("allplayers")
+        self.bot.ipc.remove_handler("songs_in_use")
+
+    async def reconcile_song_cache(self):
+        # The database isn't connected until the bot is ready
+        await self.bot.wait_until_ready()
+
+        try:
+            await self.bot.song_cache.reconcile(self.bot.db)
+        except Exception as exc:
+            log.error("Failed to load the song cache manifest.", exc_info=exc)
+
+    def local_songs_in_use(self):
+        filenames = set()
+        for player in self.bot.players.values():
+            if player.now:
+                filenames.add(player.now.filename)
+            filenames.update(song.filename for song in player.queue)
+
+        # Playlist entries that haven't been resolved yet don't have a file
+        filenames.discard(None)
+        return filenames
+
+    async def songs_in_use(self):
+        results = await self.bot.ipc.request("songs_in_use")
+        if len(results) < self.bot.cluster_count:
+            return None
+
+        return set().union(*(filenames or [] for filenames in results.values()))
+
+    async def handle_songs_in_use(self, data):
+        return list(self.local_songs_in_use())
+
+    def broadcast_song_cache_change(self, op, filename, size):
+        if self.bot.cluster_count > 1:
+            self.bot.loop.create_task(self.bot.ipc.broadcast("song_cache_update", {"op": op, "filename": filename, "size": size}))
+
+    @commands.Cog.listener()
+    async def on_ipc_song_cache_update(self, data):
+        self.bot.song_cache.apply(data["op"], data["filename"], data["size"])
+
     def cog_check(self, ctx):
         if not ctx.guild:
             raise commands.NoPrivateMessage()
@@ -906,40 +1545,110 @@ class Music(commands.Cog):
                     return await ctx.send(str(exc))
 
                 if resource_type in ("playlist", "album"):
-                    for track in tracks:
-                        song = await Song.from_query(ctx, track, search_only=True)
-                        await ctx.player.queue.put(song)
-
-                    await ctx.send(f":notepad_spiral: Finished downloading {formats.plural(len(tracks)):song} from Spotify")
+                    player = ctx.player
+                    failed = 0
+
+                    # Closed on the way out, so the tracks that are left stop resolving as soon as we give up
+                    async with contextlib.aclosing(self.resolve_tracks(ctx, tracks)) as resolved:
+                        async for track, song in resolved:
+                            if self.bot.players.get(ctx.guild.id) is not player:
+                                # The player was stopped while we were still resolving
+                                return
+
+                            if song is None:
+                                failed += 1
+                            else:
+                                await player.queue.put(song)
+
+                    message = f":notepad_spiral: Finished downloading {formats.plural(len(tracks) - failed):song} from Spotify"
+                    if failed:
+                        message += f" ({formats.plural(failed):song} couldn't be found)"
+                    await ctx.send(message)
                 else:
                     song = await Song.from_query(ctx, tracks[0], search_only=True)
+
+                    # The queue copies the interaction when the song is added
+                    if not ctx.player.is_playing and ctx.interaction:
+                        song.interaction = ctx.interaction
+
                     await ctx.player.queue.put(song)
 
                     if ctx.player.is_playing:
                         await ctx.send(f":page_facing_up: Enqueued `{song.title}`")
-                    elif ctx.interaction:
-                        song.interaction = ctx.interaction
 
         elif "list=" in query:
             if not ctx.interaction:
-                await ctx.send(":globe_with_meridians: Downloading playlist")
+                await ctx.send(":globe_with_meridians: Loading playlist")
 
             async with ctx.typing():
-                songs = await Song.playlist(ctx, query)
-                for song in songs:
-                    await ctx.player.queue.put(song)
+                songs = await Song.flat_playlist(ctx, query)
 
-            await ctx.send(f":notepad_spiral: Finished downloading {formats.plural(len(songs)):song} from playlist")
+            # Queued without their Songs, so the prefetcher resolves and downloads only the next few.
+            # Ones we already have come straight from the database.
+            ctx.player.queue.extend(QueueEntry(song) for song in songs)
+
+            await ctx.send(f":notepad_spiral: Added {formats.plural(len(songs)):song} from playlist")
         else:
             async with ctx.typing():
                 song = await Song.from_query(ctx, query)
 
+            # The queue copies the interaction when the song is added
+            if not ctx.player.is_playing and ctx.interaction:
+                song.interaction = ctx.interaction
+
             await ctx.player.queue.put(song)
 
             if ctx.player.is_playing:
                 await ctx.send(f":page_facing_up: Enqueued `{song.title}`")
-            elif ctx.interaction:
-                song.interaction = ctx.interaction
+
+    @play.autocomplete("query")
+    async def play_autocomplete(self, interaction, current):
+        # Only suggests songs we already have, which play without touching yt-dlp
+        if len(current) < 2 or "://" in current:
+            return []
+
+        started_at = time.perf_counter()
+        records = await self.search_library(current.strip())
+        self.autocomplete_duration.observe(time.perf_counter() - started_at)
+
+        return [self.song_choice(record) for record in records]
+
+    # Autocomplete asks again on every keystroke, so recent searches are kept for a bit
+    @cache.cache(max_size=1024, ttl=60)
+    async def search_library(self, search):
+        return await Song.search_library(self.bot.db, search, columns="songs.id, songs.title, songs.uploader")
+
+    def song_choice(self, record):
+        name = f"{record['title']} - {record['uploader']}" if record["uploader"] else record["title"]
+        if len(name) > 100:
+            name = f"{name[:99]}…"
+
+        # Points straight at the row, so picking a suggestion never goes through yt-dlp
+        return app_commands.Choice(name=name, value=f"{Song.library_prefix}{record['id']}")
+
+    async def resolve_tracks(self, ctx, tracks):
+        # Resolves several tracks at once but yields them in the original order, each as soon as
+        # it and every track before it are ready, so the first song can start playing right away
+        semaphore = asyncio.Semaphore(getattr(self.bot.config, "spotify_resolve_concurrency", 5))
+
+        async def resolve(track):
+            async with semaphore:
+                return await Song.from_query(ctx, track, search_only=True)
+
+        tasks = [self.bot.loop.create_task(resolve(track)) for track in tracks]
+
+        try:
+            for track, task in zip(tracks, tasks):
+                try:
+                    song = await task
+                except errors.SongError as exc:
+                    log.info("Couldn't resolve Spotify track %s.", track, exc_info=exc)
+                    song = None
+
+                yield track, song
+        finally:
+            for task in tasks:
+                task.cancel()
 
     @commands.hybrid_command(name="search", description="Search for a song on youtube")
     @commands.guild_only()
@@ -948,7 +1657,7 @@ class Music(commands.Cog):
             return await ctx.send("You are not listening to the music")
 
         async with ctx.typing():
-            songs = await Song.playlist(ctx, f"ytsearch5:{query}", download=False)
+            songs = await Song.playlist(ctx, f"ytsearch5:{query}")
 
         if not songs:
             return await ctx.send("I couldn't find any results for `{query}`")
@@ -1045,16 +1754,13 @@ class Music(commands.Cog):
         elif not ctx.player.now:
             return await ctx.send("Nothing is playing")
 
-        if position == 0 or position > len(ctx.player.queue):
+        if position < 1 or position > len(ctx.player.queue):
             return await ctx.send("That is not a song in the queue")
 
-        position = position - 1
-
-        # Remove all the song (and add them back to the end if looping) until we reach the song we want to skip to
-        for x in range(position):
-            current = await ctx.player.queue.get()
-            if ctx.player.looping_queue:
-                await ctx.player.queue.put(current)
+        # Remove all the songs before the one we want to skip to (and add them back to the end if looping)
+        skipped = ctx.player.queue.skip(position - 1)
+        if ctx.player.looping_queue:
+            ctx.player.queue.extend(skipped)
 
         ctx.player.skip()
         song = ctx.player.queue[0]
@@ -1158,7 +1864,7 @@ class Music(commands.Cog):
         if not ctx.player.queue:
             return await ctx.send("Nothing is queued to play")
 
-        song = ctx.player.queue[0]
+        song = await ctx.player.queue[0].load(ctx.player)
         await ctx.send(embed=song.embed)
 
     @commands.hybrid_group(name="queue", fallback="show", description="View the queue", invoke_without_command=True)
@@ -1174,20 +1880,30 @@ class Music(commands.Cog):
             if position == 0 or position > len(ctx.player.queue):
                 return await ctx.send("That is not a song in the queue")
 
-            song = ctx.player.queue[position-1]
+            song = await ctx.player.queue[position-1].load(ctx.player)
             await ctx.send(embed=song.embed)
 
     @queue.command(name="remove", description="Remove a song from the queue")
     async def queue_remove(self, ctx, position: int):
         if ctx.author not in ctx.player.channel.members:
             return await ctx.send("You are not listening to the music")
-        elif position < 0 or position > len(ctx.player.queue):
+        elif position < 1 or position > len(ctx.player.queue):
             return await ctx.send("That is not a valid queue position")
 
-        song = ctx.player.queue[position-1]
-        ctx.player.queue.remove(song)
+        song = ctx.player.queue.pop(position-1)
         await ctx.send(f":wastebasket: Removed `{song.title}` from queue")
 
+    @queue.command(name="move", description="Move a song to a different spot in the queue")
+    async def queue_move(self, ctx, position: int, new_position: int):
+        if ctx.author not in ctx.player.channel.members:
+            return await ctx.send("You are not listening to the music")
+        elif position < 1 or position > len(ctx.player.queue) or new_position < 1 or new_position > len(ctx.player.queue):
+            return await ctx.send("That is not a valid queue position")
+
+        ctx.player.queue.move(position-1, new_position-1)
+        song = ctx.player.queue[new_position-1]
+        await ctx.send(f":arrow_right_hook: Moved `{song.title}` to position {new_position}")
+
     @queue.command(name="clear", description="Clear the queue")
     async def queue_clear(self, ctx):
         if ctx.author not in ctx.player.channel.members:
@@ -1240,22 +1956,18 @@ class Music(commands.Cog):
     @commands.group(name="songs", description="View some stats about music", invoke_without_command=True, aliases=["song"])
     @commands.is_owner()
     async def songs(self, ctx):
-        query = """SELECT *
+        query = """SELECT COUNT(*) AS song_count,
+                          COALESCE(SUM(songs.plays), 0) AS play_count,
+                          COALESCE(SUM(songs.duration), 0) AS music_length,
+                          COALESCE(SUM(songs.duration::bigint * songs.plays), 0) AS music_played
                    FROM songs;
                 """
-        songs = await self.bot.db.fetch(query)
-        songs = [Song.from_record(song, ctx) for song in songs]
-
-        song_count = len(songs)
-        play_count = sum([song.plays for song in songs])
-        music_legnth = sum([song.total_seconds for song in songs])
-        music_played = sum([song.total_seconds*song.plays for song in songs])
-        music_cache_size = sum([os.path.getsize(song.filename) for song in songs])
+        song_count, play_count, music_legnth, music_played = await self.bot.db.fetchrow(query)
 
         em = discord.Embed(title="Music Stats", color=0x96c8da)
         em.add_field(name="Song Count", value=song_count)
         em.add_field(name="Play Count", value=play_count)
-        em.add_field(name="Music Cache Size", value=humanize.naturalsize(music_cache_size, binary=True))
+        em.add_field(name="Music Cache Size", value=f"{humanize.naturalsize(self.bot.song_cache.size, binary=True)} ({formats.plural(len(self.bot.song_cache)):file})")
         em.add_field(name="Music Legnth", value=Song.parse_duration(music_legnth))
         em.add_field(name="Music Played", value=Song.parse_duration(music_played))
         await ctx.send(embed=em)
@@ -1263,28 +1975,21 @@ class Music(commands.Cog):
     @songs.command(name="list", description="List all the songs in the database")
     @commands.is_owner()
     async def song_list(self, ctx):
-        query = """SELECT *
+        query = """SELECT songs.id, songs.title, songs.song_id, songs.extractor, songs.plays, songs.updated_at
                    FROM songs;
                 """
         songs = await self.bot.db.fetch(query)
-        songs = [Song.from_record(song, ctx) for song in songs]
 
         if not songs:
             return await ctx.send(f"I don't have any songs in my database")
 
-        songs ="\n".join([f"[{song.id}] {song.title} # {song.song_id} ({song.extractor}) | {song.plays} plays | last updated {humanize.naturaldelta(song.updated_at-datetime.datetime.utcnow())} ago" for song in songs])
+        songs ="\n".join([f"[{song['id']}] {song['title']} # {song['song_id']} ({song['extractor']}) | {song['plays']} plays | last updated {humanize.naturaldelta(song['updated_at']-datetime.datetime.utcnow())} ago" for song in songs])
         await ctx.send(f"```ini\n{songs}\n```")
 
     @songs.command(name="search", description="Search for a song in the database")
     @commands.is_owner()
     async def song_search(self, ctx, *, search):
-        query = """SELECT *
-                   FROM songs
-                   WHERE songs.title % $1
-                   ORDER BY similarity(songs.title, $1) DESC
-                   LIMIT 10;
-                """
-        songs = await self.bot.db.fetch(query, search)
+        songs = await Song.search_library(self.bot.db, search)
         songs = [Song.from_record(song, ctx) for song in songs]
 
         if not songs:
@@ -1305,7 +2010,8 @@ class Music(commands.Cog):
         em.add_field(name="Uploader", value=f"[{song.uploader}]({song.uploader_url})")
         em.add_field(name="Song ID", value=song.song_id)
         em.add_field(name="Extractor", value=song.extractor)
-        em.add_field(name="Size", value=humanize.naturalsize(os.path.getsize(song.filename), binary=True))
+        cached = self.bot.song_cache.get(song.filename)
+        em.add_field(name="Size", value=humanize.naturalsize(cached.size, binary=True) if cached else "Not downloaded")
         em.add_field(name="Filename", value=discord.utils.escape_markdown(song.filename))
         em.add_field(name="Plays", value=song.plays)
         em.add_field(name="ID", value=song.id)
@@ -1323,10 +2029,10 @@ class Music(commands.Cog):
             song = await Song.resolve_query(ctx, song.url)
             song = await Song.download_song(ctx, song)
             query = """UPDATE songs
-                       SET title=$1, filename=$2, data=$3, updated_at=$4
-                       WHERE songs.id=$5;
+                       SET title=$1, uploader=$2, duration=$3, url=$4, filename=$5, data=$6, updated_at=$7
+                       WHERE songs.id=$8;
                     """
-            await self.bot.db.execute(query, song.title, song.filename, song._data, datetime.datetime.utcnow(), song_id)
+            await self.bot.db.execute(query, song.title, song.uploader, song.total_seconds, song.url, song.filename, song.stored_data, datetime.datetime.utcnow(), song_id)
 
         await ctx.send(f":white_check_mark: `{song.title}` has been updated")
 
@@ -1339,26 +2045,40 @@ class Music(commands.Cog):
                    WHERE songs.id=$1;
                 """
         await self.bot.db.execute(query, song.id)
+        self.bot.song_cache.remove(song.filename)
         await ctx.send(f":white_check_mark: `{song.title}` has been deleted")
 
     @commands.command(name="allplayers", description="View all players")
     @commands.is_owner()
     async def allplayers(self, ctx):
-        if not self.bot.players:
+        results = await self.bot.ipc.request("allplayers")
+
+        players = []
+        for cluster_id, lines in results.items():
+            if self.bot.cluster_count > 1:
+                players.extend(f"[Cluster {cluster_id}] {line}" for line in lines or [])
+            else:
+                players.extend(lines or [])
+
+        if not players:
             return await ctx.send("No players")
 
+        await ctx.send("\n".join(players))
+
+    async def handle_allplayers(self, data):
         players = []
         for player in self.bot.players.values():
             info = f"{player.guild} - `{player.channel} | {player.text_channel}`"
             latency = f"{player.latency*1000:.2f}ms"
             players.append(f"{info} ({latency})")
 
-        await ctx.send("\n".join(players))
+        return players
 
     @commands.command(name="stopall", description="Stop all players")
     @commands.is_owner()
     async def stopall(self, ctx):
-        player_count = await self.bot.stop_players()
+        results = await self.bot.ipc.request("stopall")
+        player_count = sum(count or 0 for count in results.values())
         await ctx.send(f"{formats.plural(player_count):player} stopped.")
 
     @commands.Cog.listener()
@@ -1445,6 +2165,7 @@ class Music(commands.Cog):
     @next_.before_invoke
     @queue.before_invoke
     @queue_remove.before_invoke
+    @queue_move.before_invoke
     @queue_clear.before_invoke
     async def get_player(self, ctx):
         player = self.bot.players.get(ctx.guild.id)
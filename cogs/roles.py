@@ -259,6 +259,7 @@ class ReactionRoleView(BaseReactionRoleView):
                    VALUES($1, $2, $3, $4, $5, $6);
                 """
         await self.ctx.bot.db.execute(query, channel.guild.id, channel.id, post.id, self.title, int(self.color), [(role_id, color) for role_id, color in self.reaction_roles.items()])
+        self.ctx.cog.get_reaction_roles.invalidate(self, (channel.guild.id, channel.id, post.id))
 
         await message.reply(f"Posted reaction role menu to {channel.mention} successfully. Deleting the message will delete and disable the reaction role menu.")
         await self.done()
@@ -519,7 +520,7 @@ class Roles(commands.Cog):
 
         await ctx.send("Removed role from the autorole list.")
 
-    @cache.cache()
+    @cache.cache(max_size=1024)
     async def get_autoroles(self, guild_id):
         query = """SELECT *
                    FROM autoroles
@@ -531,7 +532,8 @@ class Roles(commands.Cog):
         roles = [guild.get_role(auto_role["role_id"]) for auto_role in autoroles]
         return [role for role in roles if role]
 
-    @cache.cache()
+    # Most reactions aren't on reaction role messages, so misses are cached too
+    @cache.cache(max_size=4096)
     async def get_reaction_roles(self, message):
         guild_id, channel_id, message_id = message
 
@@ -604,7 +606,11 @@ class Roles(commands.Cog):
         query = """DELETE FROM reaction_roles
                    WHERE reaction_roles.channel_id=$1;
                 """
-        await self.bot.db.execute(query, channel.id)
+        result = await self.bot.db.execute(query, channel.id)
+
+        if result != "DELETE 0":
+            # Keys can't be looked up by channel, so every cached menu goes
+            self.get_reaction_roles.invalidate(self)
 
     @commands.Cog.listener()
     async def on_raw_message_delete(self, payload):
@@ -614,7 +620,10 @@ class Roles(commands.Cog):
         query = """DELETE FROM reaction_roles
                    WHERE reaction_roles.channel_id=$1 AND reaction_roles.message_id=$2;
                 """
-        await self.bot.db.execute(query, payload.channel_id, payload.message_id)
+        result = await self.bot.db.execute(query, payload.channel_id, payload.message_id)
+
+        if result != "DELETE 0":
+            self.get_reaction_roles.invalidate(self, (payload.guild_id, payload.channel_id, payload.message_id))
 
     @commands.Cog.listener()
     async def on_guild_role_delete(self, role):
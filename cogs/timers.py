@@ -5,7 +5,7 @@ import discord
 from discord import app_commands
 from discord.ext import commands
 
-from .utils import formats, human_time, menus
+from .utils import db, formats, human_time, menus
 
 class RemindContextMenuModal(discord.ui.Modal, title="Remind Me"):
     duration = discord.ui.TextInput(
@@ -83,7 +83,7 @@ class TimerView(discord.ui.View):
         await self.message.edit(view=self)
 
 class Timer:
-    __slots__ = ("bot", "id", "event", "data", "expires_at", "created_at")
+    __slots__ = ("bot", "id", "event", "data", "expires_at", "created_at", "guild_id")
 
     def __init__(self, bot, **kwargs):
         self.bot = bot
@@ -92,8 +92,24 @@ class Timer:
         self.data = kwargs.get("data")
         self.expires_at = kwargs.get("expires_at")
         self.created_at = kwargs.get("created_at")
+        self.guild_id = kwargs.get("guild_id")
 
 class Timers(commands.Cog):
+    # When running as a cluster, only look at timers for our shards (and timers
+    # that aren't tied to a guild if we're the primary cluster).
+    # The counts are over every timer that matched, not just the one returned.
+    newest_timer_query = """SELECT *,
+                                   COUNT(*) OVER () AS pending,
+                                   COUNT(*) FILTER (WHERE timers.expires_at <= $4) OVER () AS overdue
+                            FROM timers
+                            WHERE $1::int[] IS NULL
+                            OR (timers.guild_id IS NULL AND $3)
+                            OR (timers.guild_id >> 22) % $2 = ANY($1::int[])
+                            ORDER BY timers.expires_at
+                            LIMIT 1;
+                         """
+    db.register("timers.get_newest_timer", newest_timer_query)
+
     def __init__(self, bot):
         self.bot = bot
         self.emoji = ":timer:"
@@ -103,6 +119,15 @@ class Timers(commands.Cog):
         self.timers_pending.set()
         self.loop = self.bot.loop.create_task(self.run_timers())
 
+        self.timers_dispatched = self.bot.metrics.counter("timers_dispatched_total", "Timers dispatched, by event", ["event"])
+        self.timer_delay = self.bot.metrics.histogram("timer_delay_seconds", "How late timers were dispatched after they expired", ["event"])
+
+        # Updated whenever the timer loop looks for the next timer
+        self.pending_timers = 0
+        self.overdue_timers = 0
+        self.bot.metrics.gauge("timers_pending", "Timers waiting to be dispatched by this cluster", function=lambda: self.pending_timers)
+        self.bot.metrics.gauge("timers_overdue", "Timers past their expiry that haven't been dispatched yet", function=lambda: self.overdue_timers)
+
         self._remind_context_menu = app_commands.ContextMenu(name="Remind Later", callback=self.context_menu_remind)
         self.bot.tree.add_command(self._remind_context_menu)
 
@@ -240,33 +265,52 @@ class Timers(commands.Cog):
     async def reminders(self, ctx):
         await ctx.invoke(self.remind_list)
 
-    async def create_timer(self, event, data, expires_at, created_at):
+    async def create_timer(self, event, data, expires_at, created_at, *, guild_id=None):
         expires_at = expires_at.replace(tzinfo=None)
         created_at = created_at.replace(tzinfo=None)
 
-        query = """INSERT INTO timers (event, data, expires_at, created_at)
-                   VALUES ($1, $2, $3, $4)
+        query = """INSERT INTO timers (event, data, expires_at, created_at, guild_id)
+                   VALUES ($1, $2, $3, $4, $5)
                    RETURNING id;
                 """
-        value = await self.bot.db.fetchval(query, event, data, expires_at, created_at)
-        timer = Timer(self.bot, id=value, event=event, expires_at=expires_at, data=data, created_at=created_at)
-        if self.current_timer and timer.expires_at < self.current_timer.expires_at:
+        value = await self.bot.db.fetchval(query, event, data, expires_at, created_at, guild_id)
+        timer = Timer(self.bot, id=value, event=event, expires_at=expires_at, data=data, created_at=created_at, guild_id=guild_id)
+
+        if self.owns_timer(timer):
+            self.timer_created(timer.expires_at)
+        else:
+            # The timer belongs to another cluster, which might be sleeping for longer than this timer
+            await self.bot.ipc.broadcast("timer_created", {"expires_at": timer.expires_at.isoformat()})
+
+        return timer
+
+    def timer_created(self, expires_at):
+        if self.current_timer and expires_at < self.current_timer.expires_at:
             # Loop is currently sleeping for longer than the current timer so we need to cancel and re-run it
             self.restart_loop()
 
         self.timers_pending.set()
-        return timer
+
+    def owns_timer(self, timer):
+        if self.bot.shard_ids is None:
+            return True
+        if timer.guild_id is None:
+            return self.bot.is_primary
+
+        return (timer.guild_id >> 22) % self.bot.shard_count in self.bot.shard_ids
 
     async def get_newest_timer(self):
-        query = """SELECT *
-                   FROM timers
-                   ORDER BY timers.expires_at
-                   LIMIT 1;
-                """
-        timer = await self.bot.db.fetchrow(query)
+        timer = await self.bot.db.fetchrow(self.newest_timer_query, self.bot.shard_ids, self.bot.shard_count, self.bot.is_primary, datetime.datetime.utcnow())
+        self.pending_timers = timer["pending"] if timer else 0
+        self.overdue_timers = timer["overdue"] if timer else 0
+
         if timer:
             return Timer(self.bot, **dict(timer))
 
+    @commands.Cog.listener()
+    async def on_ipc_timer_created(self, data):
+        self.timer_created(datetime.datetime.fromisoformat(data["expires_at"]))
+
     async def run_timers(self):
         await self.bot.wait_until_ready()
 
@@ -287,11 +331,15 @@ class Timers(commands.Cog):
             if time.total_seconds():
                 await asyncio.sleep(time.total_seconds())
 
+            # Only dispatch the timer if we were the ones to delete it, so it can never fire twice
             query = """DELETE FROM timers
-                       WHERE timers.id=$1;
+                       WHERE timers.id=$1
+                       RETURNING id;
                     """
-            await self.bot.db.execute(query, timer.id)
-            self.bot.dispatch(f"{timer.event}_complete", timer)
+            if await self.bot.db.fetchval(query, timer.id) is not None:
+                self.timers_dispatched.inc(event=timer.event)
+                self.timer_delay.observe(max((datetime.datetime.utcnow()-timer.expires_at).total_seconds(), 0), event=timer.event)
+                self.bot.dispatch(f"{timer.event}_complete", timer)
 
     def restart_loop(self):
         self.loop.cancel()
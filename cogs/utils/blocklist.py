@@ -0,0 +1,184 @@
+import bisect
+import itertools
+
+class BlockList:
+    """A list stored as a list of small blocks.
+
+    Inserting or deleting anywhere only shifts the items in one block, and finding an
+    index is a binary search over where each block starts, so nothing is linear in the
+    length of the whole list like it would be for a deque or a list.
+    """
+
+    __slots__ = ("load", "_blocks", "_offsets", "_length")
+
+    def __init__(self, iterable=(), *, load=512):
+        self.load = load
+        self._blocks = []
+
+        # Index of the first item in every block, rebuilt when it's needed after the blocks change
+        self._offsets = []
+        self._length = 0
+
+        self.extend(iterable)
+
+    def __repr__(self):
+        return f"BlockList({list(self)!r})"
+
+    def __len__(self):
+        return self._length
+
+    def __bool__(self):
+        return self._length != 0
+
+    def __iter__(self):
+        return itertools.chain.from_iterable(self._blocks)
+
+    def __reversed__(self):
+        for block in reversed(self._blocks):
+            yield from reversed(block)
+
+    def __contains__(self, value):
+        return any(value in block for block in self._blocks)
+
+    def _locate(self, index):
+        if index < 0:
+            index += self._length
+        if not 0 <= index < self._length:
+            raise IndexError("BlockList index out of range")
+
+        if self._offsets is None:
+            self._offsets = list(itertools.accumulate((len(block) for block in self._blocks[:-1]), initial=0))
+
+        block = bisect.bisect_right(self._offsets, index) - 1
+        return block, index - self._offsets[block]
+
+    def _range(self, start, stop):
+        # Yields the items from start to stop without going through the blocks before start
+        if start >= stop:
+            return
+
+        block, position = self._locate(start)
+        remaining = stop - start
+
+        for items in itertools.islice(self._blocks, block, None):
+            chunk = items[position:position + remaining]
+            yield from chunk
+
+            remaining -= len(chunk)
+            if not remaining:
+                return
+            position = 0
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(self._length)
+            if step == 1:
+                return list(self._range(start, stop))
+            return [self[i] for i in range(start, stop, step)]
+
+        block, position = self._locate(index)
+        return self._blocks[block][position]
+
+    def __setitem__(self, index, value):
+        block, position = self._locate(index)
+        self._blocks[block][position] = value
+
+    def __delitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(self._length)
+            if step != 1:
+                # Deleting from the back keeps the earlier indexes valid
+                for i in sorted(range(start, stop, step), reverse=True):
+                    del self[i]
+                return
+
+            count = max(stop - start, 0)
+            while count:
+                block, position = self._locate(start)
+                items = self._blocks[block]
+                removed = min(count, len(items) - position)
+
+                del items[position:position + removed]
+                self._length -= removed
+                count -= removed
+
+                if not items:
+                    del self._blocks[block]
+                self._offsets = None
+
+            return
+
+        block, position = self._locate(index)
+        items = self._blocks[block]
+        del items[position]
+        self._length -= 1
+
+        if not items:
+            del self._blocks[block]
+        self._offsets = None
+
+    def append(self, value):
+        if not self._blocks or len(self._blocks[-1]) >= self.load:
+            if self._offsets is not None:
+                self._offsets.append(self._length)
+            self._blocks.append([value])
+        else:
+            self._blocks[-1].append(value)
+
+        self._length += 1
+
+    def extend(self, iterable):
+        for value in iterable:
+            self.append(value)
+
+    def insert(self, index, value):
+        if index < 0:
+            index = max(index + self._length, 0)
+        if index >= self._length:
+            return self.append(value)
+
+        block, position = self._locate(index)
+        items = self._blocks[block]
+        items.insert(position, value)
+        self._length += 1
+
+        # Blocks are split once they're twice as big as they should be, so no single insert or delete gets slow
+        if len(items) > self.load * 2:
+            self._blocks[block:block + 1] = [items[:self.load], items[self.load:]]
+        self._offsets = None
+
+    def pop(self, index=-1):
+        value = self[index]
+        del self[index]
+        return value
+
+    def popleft(self):
+        if not self._length:
+            raise IndexError("pop from an empty BlockList")
+
+        items = self._blocks[0]
+        value = items.pop(0)
+        self._length -= 1
+
+        if not items:
+            del self._blocks[0]
+        self._offsets = None
+        return value
+
+    def index(self, value):
+        for offset, item in enumerate(self):
+            if item is value or item == value:
+                return offset
+
+        raise ValueError(f"{value!r} is not in BlockList")
+
+    def remove(self, value):
+        del self[self.index(value)]
+
+    def move(self, source, destination):
+        self.insert(destination, self.pop(source))
+
+    def clear(self):
+        self._blocks.clear()
+        self._offsets = []
+        self._length = 0
@@ -2,77 +2,283 @@ import asyncio
 import collections
 import functools
 import inspect
+import json
+import logging
+import secrets
+import time
 
-class LRUDict(collections.OrderedDict):
-    def __init__(self, max_legnth = 10, *args, **kwargs):
-        if max_legnth <= 0:
-            raise ValueError()
-        self.max_legnth = max_legnth
+log = logging.getLogger("robo_coder.cache")
 
-        super().__init__(*args, **kwargs)
+# Every cached function, by qualified name, so their stats can be looked at in one place
+caches = {}
 
-    def __setitem__(self, key, value):
-        super().__setitem__(key, value)
+# Invalidates a key in one cache without publishing it, by qualified name
+_invalidators = {}
 
-        if len(self) > 10:
-            super().__delitem__(list(self)[0])
+# Set once the bot is connected to the database, so invalidations reach every process
+bus = None
 
-    def __getitem__(self, key):
-        value = super().__getitem__(key)
-        self.move_to_end(key)
+class CacheStats:
+    __slots__ = ("hits", "misses", "evictions", "expirations", "coalesced")
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.coalesced = 0
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0
+
+class LRUCache:
+    """A mapping that holds at most max_size entries, evicting the least recently used one."""
+
+    __slots__ = ("max_size", "ttl", "stats", "_entries")
+
+    def __init__(self, max_size=128, *, ttl=None):
+        if max_size <= 0:
+            raise ValueError("max_size must be positive")
+
+        self.max_size = max_size
+        self.ttl = ttl
+        self.stats = CacheStats()
+
+        # Values are stored with the time they expire at (or None if they never do)
+        self._entries = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        try:
+            self.get(key, record=False)
+        except KeyError:
+            return False
+        return True
+
+    def get(self, key, *, record=True):
+        try:
+            value, expires_at = self._entries[key]
+        except KeyError:
+            if record:
+                self.stats.misses += 1
+            raise
+
+        if expires_at is not None and time.monotonic() >= expires_at:
+            del self._entries[key]
+            if record:
+                self.stats.expirations += 1
+                self.stats.misses += 1
+            raise KeyError(key)
+
+        self._entries.move_to_end(key)
+        if record:
+            self.stats.hits += 1
         return value
 
-def cache(max_legnth = 128):
+    def set(self, key, value):
+        expires_at = time.monotonic() + self.ttl if self.ttl is not None else None
+        self._entries[key] = (value, expires_at)
+        self._entries.move_to_end(key)
+
+        if len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.stats.evictions += 1
+
+    def pop(self, key, default=None):
+        entry = self._entries.pop(key, None)
+        return entry[0] if entry is not None else default
+
+    def clear(self):
+        self._entries.clear()
+
+class _Missing:
+    __slots__ = ()
+
+    def __repr__(self):
+        return "<missing>"
+
+_missing = _Missing()
+_kwargs_mark = object()
+
+def _make_key(args, kwargs):
+    # Tuples hash and compare by value, unlike the repr strings this used to build
+    if kwargs:
+        return (*args, _kwargs_mark, *sorted(kwargs.items()))
+    return args
+
+def cache(max_size=128, *, ttl=None):
     def decorator(func):
-        cache = LRUDict(max_legnth=max_legnth)
+        cache = LRUCache(max_size=max_size, ttl=ttl)
+
+        name = f"{func.__module__}.{func.__qualname__}"
 
-        def __len__():
-            return len(cache)
+        # Calls that are still running, so concurrent misses for a key share one call
+        pending = {}
+
+        # Methods are cached per arguments, not per instance, so self isn't part of the key.
+        # That also lets callers invalidate without having the same instance on hand.
+        parameters = list(inspect.signature(func).parameters)
+        skip = 1 if parameters and parameters[0] in ("self", "cls") else 0
 
         def _get_key(*args, **kwargs):
-            return f"{':'.join([repr(arg) for arg in args])}{':'.join([f'{repr(kwarg)}={repr(value)}' for kwarg, value in kwargs.items()])}"
+            return _make_key(args[skip:], kwargs)
 
-        def invalidate(*args, **kwargs):
-            if not args:
+        def invalidate_local(args, kwargs):
+            # A call that's still running was started before the change, so its result isn't cached
+            if not args and not kwargs:
                 cache.clear()
+                pending.clear()
                 return
 
+            key = _make_key(args, kwargs)
+            pending.pop(key, None)
+            return cache.pop(key, _missing) is not _missing
+
+        def invalidate(*args, **kwargs):
+            if bus is not None:
+                bus.publish(name, args[skip:], kwargs)
+
+            return invalidate_local(args[skip:], kwargs)
+
+        def lookup(args, kwargs):
+            key = _get_key(*args, **kwargs)
             try:
-                key = _get_key(*args, **kwargs)
-                cache.pop(key)
-                return True
+                return key, cache.get(key)
             except KeyError:
-                return False
+                return key, _missing
+            except TypeError:
+                # Unhashable arguments can't be cached, so the call just goes through
+                cache.stats.misses += 1
+                return None, _missing
 
-        @functools.wraps(func)
-        def wrapped(*args, **kwargs):
-            key = _get_key(*args, **kwargs)
+        if asyncio.iscoroutinefunction(func):
+            def finished(key, task):
+                if pending.get(key) is not task:
+                    return
 
-            try:
-                value = cache[key]
-                if asyncio.iscoroutinefunction(func):
-                    async def coro():
-                        return value
-                    return coro()
-                return value
+                del pending[key]
+                if not task.cancelled() and task.exception() is None:
+                    cache.set(key, task.result())
+
+            @functools.wraps(func)
+            async def wrapped(*args, **kwargs):
+                key, value = lookup(args, kwargs)
+                if value is not _missing:
+                    return value
+                if key is None:
+                    return await func(*args, **kwargs)
+
+                task = pending.get(key)
+                if task is not None:
+                    cache.stats.coalesced += 1
+                else:
+                    task = pending[key] = asyncio.ensure_future(func(*args, **kwargs))
+                    task.add_done_callback(functools.partial(finished, key))
+
+                # Shielded so a caller being cancelled doesn't cancel the call for everyone else waiting on it.
+                # Exceptions reach every caller and nothing is cached.
+                return await asyncio.shield(task)
+        else:
+            @functools.wraps(func)
+            def wrapped(*args, **kwargs):
+                key, value = lookup(args, kwargs)
+                if value is not _missing:
+                    return value
 
-            except KeyError:
                 value = func(*args, **kwargs)
-                if inspect.isawaitable(value):
-                    async def coro():
-                        result = await value
-                        cache[key] = result
-                        return result
-                    return coro()
-
-                cache[key] = value
+                if key is not None:
+                    cache.set(key, value)
                 return value
 
-
         wrapped.invalidate = invalidate
         wrapped.cache = cache
+        wrapped.stats = cache.stats
         wrapped._get_key = _get_key
-        wrapped.__len__ = __len__
+
+        caches[name] = cache
+        _invalidators[name] = invalidate_local
         return wrapped
 
     return decorator
+
+def _thaw(value):
+    # JSON turns tuples into lists, which would neither hash nor match the original key
+    if isinstance(value, list):
+        return tuple(_thaw(item) for item in value)
+    return value
+
+class InvalidationBus:
+    """Sends cache invalidations to every process using Postgres LISTEN/NOTIFY."""
+
+    channel = "cache_invalidation"
+
+    def __init__(self, db):
+        self.db = db
+        self.origin = secrets.token_hex(8)
+
+        self.published = 0
+        self.received = 0
+        self._connection = None
+        self._closed = False
+
+    async def start(self):
+        # LISTEN needs a connection of its own for as long as we're subscribed
+        self._connection = await self.db.pool.acquire()
+        await self._connection.add_listener(self.channel, self.on_notification)
+        self._connection.add_termination_listener(self.on_termination)
+
+    async def close(self):
+        self._closed = True
+        if self._connection is not None and not self._connection.is_closed():
+            await self._connection.remove_listener(self.channel, self.on_notification)
+            await self.db.pool.release(self._connection)
+
+    def publish(self, namespace, args, kwargs):
+        payload = json.dumps({"origin": self.origin, "namespace": namespace, "args": args, "kwargs": kwargs})
+        self.published += 1
+        asyncio.get_running_loop().create_task(self._publish(payload))
+
+    async def _publish(self, payload):
+        try:
+            await self.db.execute("SELECT pg_notify($1, $2);", self.channel, payload)
+        except Exception as exc:
+            log.warning("Failed to publish cache invalidation.", exc_info=exc)
+
+    def on_notification(self, connection, pid, channel, payload):
+        data = json.loads(payload)
+        if data["origin"] == self.origin:
+            return
+
+        invalidate = _invalidators.get(data["namespace"])
+        if invalidate is not None:
+            self.received += 1
+            invalidate(_thaw(data["args"]), {key: _thaw(value) for key, value in data["kwargs"].items()})
+
+    def on_termination(self, connection):
+        if self._closed:
+            return
+
+        # Anything published while we weren't listening was missed, so nothing cached can be trusted
+        log.warning("Lost the cache invalidation connection. Clearing caches and resubscribing.")
+        for invalidate in _invalidators.values():
+            invalidate((), {})
+
+        asyncio.get_running_loop().create_task(self._resubscribe())
+
+    async def _resubscribe(self):
+        try:
+            await self.db.pool.release(self._connection)
+        except Exception:
+            pass
+
+        while not self._closed:
+            try:
+                await self.start()
+                return
+            except Exception as exc:
+                log.warning("Failed to resubscribe to cache invalidations.", exc_info=exc)
+                await asyncio.sleep(5)
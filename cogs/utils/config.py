@@ -1,28 +1,135 @@
 import asyncio
 import json
+import logging
 import os
 
+log = logging.getLogger("robo_coder.config")
+
 class Config:
-    def __init__(self, filename):
+    """A JSON file whose changes are appended to a journal off the loop and compacted in the background."""
+
+    def __init__(self, filename, *, compact_after=1000, persist=True):
         self.filename = filename
+        self.persist = persist
+        self.on_change = None
+        self.journal_filename = f"{filename}.journal"
+        self.compact_after = compact_after
         self.lock = asyncio.Lock()
-        self._load()
 
-    def _load(self):
+        self._data = None
+        self._pending = []
+        self._journal_size = 0
+        self._writer = None
+
+    @property
+    def data(self):
+        # Fall back to loading on the loop if something needs the data before load() finished
+        if self._data is None:
+            self._data, self._journal_size = self._read()
+        return self._data
+
+    async def load(self):
+        if self._data is not None:
+            return
+
+        data, journal_size = await asyncio.get_running_loop().run_in_executor(None, self._read)
+
+        if self._data is None:
+            self._data, self._journal_size = data, journal_size
+
+    def _read(self):
         if os.path.exists(self.filename):
             with open(self.filename, "r") as file:
-                self.data = json.load(file)
+                data = json.load(file)
         else:
-            self.data = {}
+            data = {}
+
+        journal_size = 0
+        if os.path.exists(self.journal_filename):
+            with open(self.journal_filename, "r") as file:
+                for line in file:
+                    try:
+                        key, value, deleted = json.loads(line)
+                    except ValueError:
+                        # A torn write from a crash can only ever be the last line, and
+                        # it has to be compacted away before anything else is appended
+                        log.warning("Ignoring incomplete journal entry in %s.", self.journal_filename)
+                        self._compact(data)
+                        return data, 0
+
+                    if deleted:
+                        data.pop(key, None)
+                    else:
+                        data[key] = value
+
+                    journal_size += 1
+
+        return data, journal_size
+
+    def _journal(self, key, value=None, deleted=False, *, notify=True):
+        if notify and self.on_change is not None:
+            self.on_change(self, key, value, deleted)
+
+        if not self.persist:
+            # Another process owns the file, so there's nothing to wait for
+            future = asyncio.get_running_loop().create_future()
+            future.set_result(None)
+            return future
+
+        self._pending.append(json.dumps([key, value, deleted]) + "\n")
+
+        if self._writer is None or self._writer.done():
+            self._writer = asyncio.create_task(self._write_pending())
+
+        return self._writer
+
+    async def _write_pending(self):
+        loop = asyncio.get_running_loop()
+
+        while self._pending:
+            entries, self._pending = self._pending, []
+            await loop.run_in_executor(None, self._append, entries)
+            self._journal_size += len(entries)
+
+            # Only compact once everything queued is in the journal, so the snapshot matches it exactly
+            if self._journal_size >= self.compact_after and not self._pending:
+                snapshot = dict(self._data)
+                await loop.run_in_executor(None, self._compact, snapshot)
+                self._journal_size = 0
+
+    def _append(self, entries):
+        with open(self.journal_filename, "a") as file:
+            file.writelines(entries)
+
+    def _compact(self, snapshot):
+        # The snapshot already contains every journaled change, so replacing the
+        # file before truncating the journal never loses anything
+        temp = f"{self.filename}.tmp"
+        with open(temp, "w") as file:
+            json.dump(snapshot, file)
+        os.replace(temp, self.filename)
+
+        with open(self.journal_filename, "w"):
+            pass
 
     def dump(self):
-        with open(self.filename, "w") as file:
-            json.dump(self.data, file)
+        self._compact(self.data)
+        self._journal_size = 0
+
+    async def flush(self):
+        if self._writer is not None:
+            await self._writer
+
+    async def close(self):
+        await self.flush()
+
+        if self.persist and self._data is not None and self._journal_size:
+            await asyncio.get_running_loop().run_in_executor(None, self.dump)
 
     async def add(self, key, value):
         async with self.lock:
             self.data[str(key)] = value
-            self.dump()
+            await self._journal(str(key), value)
 
     async def remove(self, key):
         async with self.lock:
@@ -30,7 +137,16 @@ class Config:
                 return
 
             del self.data[str(key)]
-            self.dump()
+            await self._journal(str(key), deleted=True)
+
+    def apply(self, key, value, deleted):
+        # Applies a change made by another process without announcing it again
+        if deleted:
+            self.data.pop(key, None)
+        else:
+            self.data[key] = value
+
+        self._journal(key, value, deleted, notify=False)
 
     def get(self, key, default=None):
         return self.data.get(str(key), default)
@@ -40,11 +156,11 @@ class Config:
 
     def __setitem__(self, key, value):
         self.data[str(key)] = value
-        self.dump()
+        self._journal(str(key), value)
 
-    def __delitem__(self, key, value):
+    def __delitem__(self, key):
         del self.data[str(key)]
-        self.dump()
+        self._journal(str(key), deleted=True)
 
     def __iter__(self):
         return self.data.__iter__()
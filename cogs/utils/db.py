@@ -0,0 +1,172 @@
+import asyncio
+import bisect
+import time
+
+import asyncpg
+
+from . import tracing
+
+# Upper bounds of the latency histogram buckets, in milliseconds
+BUCKETS = (1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, float("inf"))
+
+# Normalised query text to the name its stats are kept under.
+# Cogs register their hot queries when they're imported, before the database even exists.
+names = {}
+
+def register(name, query):
+    names[" ".join(query.split())] = name
+    return query
+
+class QueryStats:
+    __slots__ = ("name", "calls", "errors", "rows", "total_time", "max_time", "buckets")
+
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+        self.errors = 0
+        self.rows = 0
+        self.total_time = 0
+        self.max_time = 0
+        self.buckets = [0] * len(BUCKETS)
+
+    def record(self, duration, rows):
+        self.calls += 1
+        self.rows += rows
+        self.total_time += duration
+        self.max_time = max(self.max_time, duration)
+        self.buckets[bisect.bisect_left(BUCKETS, duration * 1000)] += 1
+
+    @property
+    def average_time(self):
+        return self.total_time / self.calls if self.calls else 0
+
+    def percentile(self, percentile):
+        # Returns the upper bound (in seconds) of the bucket the percentile falls into
+        target = self.calls * percentile / 100
+        count = 0
+
+        for bound, bucket in zip(BUCKETS, self.buckets):
+            count += bucket
+            if count >= target and count:
+                return min(bound / 1000, self.max_time)
+
+        return self.max_time
+
+class Database:
+    """Wraps the connection pool and records latency stats for every query."""
+
+    def __init__(self, pool, *, acquire_timeout=30, max_queries=256):
+        self.pool = pool
+        self.acquire_timeout = acquire_timeout
+
+        # Unnamed queries get their own stats until there are this many, then they're lumped together
+        self.max_queries = max_queries
+
+        self.queries = {}
+        self._keys = {}
+
+        self.acquires = 0
+        self.acquire_timeouts = 0
+        self.wait_time = 0
+        self.max_wait_time = 0
+
+    @classmethod
+    async def create(cls, dsn, **kwargs):
+        pool = await asyncpg.create_pool(dsn, **kwargs)
+        return cls(pool)
+
+    def get_stats(self, query):
+        # asyncpg prepares every query once per connection and keeps it in its statement cache,
+        # so registering a query only needs to give it a readable name
+        try:
+            key = self._keys[query]
+        except KeyError:
+            normalized = " ".join(query.split())
+            key = names.get(normalized)
+
+            if key is None:
+                if len(self.queries) >= self.max_queries and normalized not in self.queries:
+                    # Not remembered, so one-off queries can't grow this forever
+                    key = "(other)"
+                else:
+                    key = normalized
+
+            if key != "(other)":
+                self._keys[query] = key
+
+        try:
+            return self.queries[key]
+        except KeyError:
+            stats = self.queries[key] = QueryStats(key)
+            return stats
+
+    @property
+    def pool_size(self):
+        return self.pool.get_size()
+
+    @property
+    def pool_idle(self):
+        return self.pool.get_idle_size()
+
+    @property
+    def pool_max_size(self):
+        return self.pool.get_max_size()
+
+    @property
+    def average_wait_time(self):
+        return self.wait_time / self.acquires if self.acquires else 0
+
+    async def _run(self, method, query, args, timeout, count_rows):
+        stats = self.get_stats(query)
+
+        with tracing.span(f"db.{method}", query=stats.name):
+            return await self._run_query(stats, method, query, args, timeout, count_rows)
+
+    async def _run_query(self, stats, method, query, args, timeout, count_rows):
+        started_at = time.perf_counter()
+        try:
+            connection = await self.pool.acquire(timeout=self.acquire_timeout)
+        except asyncio.TimeoutError:
+            self.acquire_timeouts += 1
+            raise
+
+        waited = time.perf_counter() - started_at
+        self.acquires += 1
+        self.wait_time += waited
+        self.max_wait_time = max(self.max_wait_time, waited)
+
+        try:
+            started_at = time.perf_counter()
+            result = await getattr(connection, method)(query, *args, timeout=timeout)
+        except Exception:
+            stats.errors += 1
+            raise
+        finally:
+            await self.pool.release(connection)
+
+        stats.record(time.perf_counter() - started_at, count_rows(result))
+        return result
+
+    async def execute(self, query, *args, timeout=None):
+        return await self._run("execute", query, args, timeout, self._count_status)
+
+    async def fetch(self, query, *args, timeout=None):
+        return await self._run("fetch", query, args, timeout, len)
+
+    async def fetchrow(self, query, *args, timeout=None):
+        return await self._run("fetchrow", query, args, timeout, lambda record: int(record is not None))
+
+    async def fetchval(self, query, *args, timeout=None):
+        return await self._run("fetchval", query, args, timeout, lambda value: int(value is not None))
+
+    def acquire(self, *, timeout=None):
+        return self.pool.acquire(timeout=timeout)
+
+    async def close(self):
+        await self.pool.close()
+
+    @staticmethod
+    def _count_status(status):
+        # Statuses look like "INSERT 0 1", "UPDATE 3" or "CREATE TABLE"
+        count = status.rsplit(" ", 1)[-1] if status else ""
+        return int(count) if count.isdigit() else 0
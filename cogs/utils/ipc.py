@@ -0,0 +1,181 @@
+import asyncio
+import json
+import logging
+import secrets
+
+log = logging.getLogger("robo_coder.ipc")
+
+# Messages are JSON objects, one per line, sent over a localhost socket.
+# Every cluster connects to the hub in the launcher, which relays broadcasts
+# to the other clusters and routes request responses back to the cluster that asked.
+
+async def send(writer, message):
+    writer.write(json.dumps(message).encode() + b"\n")
+    await writer.drain()
+
+class Hub:
+    def __init__(self, *, port, secret):
+        self.port = port
+        self.secret = secret
+
+        self.clusters = {}
+        self.server = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle_connection, "127.0.0.1", self.port)
+        log.info("IPC hub listening on port %s.", self.port)
+
+    async def close(self):
+        if self.server:
+            self.server.close()
+            await self.server.wait_closed()
+
+    async def handle_connection(self, reader, writer):
+        cluster_id = None
+
+        try:
+            identify = json.loads(await reader.readline())
+            if identify.get("op") != "identify" or not secrets.compare_digest(str(identify.get("secret")), self.secret):
+                log.warning("Rejecting IPC connection that failed to identify.")
+                return
+
+            cluster_id = identify["cluster_id"]
+            self.clusters[cluster_id] = writer
+            log.info("Cluster %s connected to IPC.", cluster_id)
+
+            async for line in reader:
+                message = json.loads(line)
+
+                if message["op"] in ("broadcast", "request"):
+                    targets = [target for target_id, target in self.clusters.items() if target_id != cluster_id]
+                elif message["op"] == "response" and message["to"] in self.clusters:
+                    targets = [self.clusters[message["to"]]]
+                else:
+                    continue
+
+                for target in targets:
+                    try:
+                        await send(target, message)
+                    except ConnectionError:
+                        pass
+
+        except (ConnectionError, ValueError) as exc:
+            log.warning("IPC connection for cluster %s failed.", cluster_id, exc_info=exc)
+        finally:
+            if cluster_id is not None and self.clusters.get(cluster_id) is writer:
+                del self.clusters[cluster_id]
+                log.info("Cluster %s disconnected from IPC.", cluster_id)
+
+            writer.close()
+
+class Client:
+    """One cluster's connection to the hub.
+
+    Without a port this only runs the local handlers, so callers can use it the
+    same way whether the bot is running as one process or many.
+    """
+
+    def __init__(self, bot, *, cluster_id=0, cluster_count=1, port=None, secret=None):
+        self.bot = bot
+        self.cluster_id = cluster_id
+        self.cluster_count = cluster_count
+        self.port = port
+        self.secret = secret
+
+        self.handlers = {}
+        self._writer = None
+        self._requests = {}
+        self._task = None
+
+    @property
+    def is_connected(self):
+        return self._writer is not None
+
+    def start(self):
+        if self.port is not None:
+            self._task = self.bot.loop.create_task(self._run())
+
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+        if self._writer:
+            self._writer.close()
+
+    def add_handler(self, name, handler):
+        self.handlers[name] = handler
+
+    def remove_handler(self, name):
+        self.handlers.pop(name, None)
+
+    async def broadcast(self, event, data=None):
+        if self._writer is None:
+            return
+
+        await send(self._writer, {"op": "broadcast", "event": event, "data": data, "from": self.cluster_id})
+
+    async def request(self, command, data=None, *, timeout=5):
+        # Returns a dict of cluster ID to the result of the handler on that cluster
+        results = {}
+        results[self.cluster_id] = await self.handlers[command](data)
+
+        if self._writer is None or self.cluster_count == 1:
+            return results
+
+        nonce = secrets.token_hex(8)
+        future = self.bot.loop.create_future()
+        self._requests[nonce] = (results, future)
+
+        try:
+            await send(self._writer, {"op": "request", "command": command, "data": data, "from": self.cluster_id, "nonce": nonce})
+            await asyncio.wait_for(future, timeout=timeout)
+        except asyncio.TimeoutError:
+            log.warning("IPC request %s only got responses from %s/%s clusters.", command, len(results), self.cluster_count)
+        finally:
+            del self._requests[nonce]
+
+        return dict(sorted(results.items()))
+
+    async def _run(self):
+        while True:
+            try:
+                reader, writer = await asyncio.open_connection("127.0.0.1", self.port)
+                await send(writer, {"op": "identify", "cluster_id": self.cluster_id, "secret": self.secret})
+                self._writer = writer
+                log.info("Connected to IPC hub as cluster %s.", self.cluster_id)
+
+                async for line in reader:
+                    self.bot.loop.create_task(self._handle(json.loads(line)))
+            except (ConnectionError, OSError) as exc:
+                log.warning("Lost connection to IPC hub. Reconnecting.", exc_info=exc)
+            finally:
+                self._writer = None
+
+            await asyncio.sleep(5)
+
+    async def _handle(self, message):
+        if message["op"] == "broadcast":
+            self.bot.dispatch(f"ipc_{message['event']}", message["data"])
+
+        elif message["op"] == "request":
+            handler = self.handlers.get(message["command"])
+            if handler is None:
+                return
+
+            try:
+                result = await handler(message["data"])
+            except Exception as exc:
+                log.error("Exception in IPC handler %s.", message["command"], exc_info=exc)
+                result = None
+
+            if self._writer:
+                await send(self._writer, {"op": "response", "nonce": message["nonce"], "to": message["from"], "from": self.cluster_id, "data": result})
+
+        elif message["op"] == "response":
+            request = self._requests.get(message["nonce"])
+            if request is None:
+                return
+
+            results, future = request
+            results[message["from"]] = message["data"]
+            if len(results) >= self.cluster_count and not future.done():
+                future.set_result(None)
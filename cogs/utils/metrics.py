@@ -0,0 +1,172 @@
+import bisect
+import logging
+import math
+
+from aiohttp import web
+
+log = logging.getLogger("robo_coder.metrics")
+
+# Latency buckets in seconds, matching the ones the Prometheus client uses by default
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.075, 0.1, 0.25, 0.5, 0.75, 1, 2.5, 5, 7.5, 10, math.inf)
+
+def format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+def format_labels(names, values, extra=None):
+    pairs = list(zip(names, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+
+    escaped = (str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+class Metric:
+    type = None
+
+    def __init__(self, name, documentation, labels=(), *, function=None):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.function = function
+        self._values = {}
+
+    def _key(self, labels):
+        if labels.keys() != set(self.labels):
+            raise ValueError(f"{self.name} expects labels {self.labels}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labels)
+
+    def samples(self):
+        if self.function is None:
+            for key, value in self._values.items():
+                yield self.name, key, None, value
+            return
+
+        # Metrics backed by a function are read when scraped instead of being kept up to date,
+        # which suits anything the bot already tracks. Labelled ones return a dict of label values to value.
+        try:
+            values = self.function()
+        except Exception as exc:
+            log.warning("Failed to collect %s.", self.name, exc_info=exc)
+            return
+
+        if not self.labels:
+            values = {(): values}
+
+        for key, value in values.items():
+            yield self.name, key if isinstance(key, tuple) else (key,), None, value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        for name, key, extra, value in self.samples():
+            lines.append(f"{name}{format_labels(self.labels, key, extra)} {format_value(value)}")
+        return "\n".join(lines)
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def set(self, value, **labels):
+        self._values[self._key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name, documentation, labels=(), *, buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets) if buckets[-1] == math.inf else (*buckets, math.inf)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        try:
+            counts, total = self._values[key]
+        except KeyError:
+            counts, total = [0] * len(self.buckets), 0
+
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        self._values[key] = (counts, total + value)
+
+    def samples(self):
+        for key, (counts, total) in self._values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                yield f"{self.name}_bucket", key, ("le", format_value(bound)), cumulative
+
+            yield f"{self.name}_count", key, None, cumulative
+            yield f"{self.name}_sum", key, None, total
+
+class Registry:
+    def __init__(self, namespace="robo_coder"):
+        self.namespace = namespace
+        self.metrics = {}
+
+    def _register(self, cls, name, *args, **kwargs):
+        name = f"{self.namespace}_{name}"
+
+        # Extensions get reloaded, so asking for an existing metric returns it instead of resetting it
+        try:
+            metric = self.metrics[name]
+        except KeyError:
+            metric = self.metrics[name] = cls(name, *args, **kwargs)
+            return metric
+
+        if type(metric) is not cls:
+            raise ValueError(f"{name} is already registered as a {metric.type}")
+        if kwargs.get("function") is not None:
+            metric.function = kwargs["function"]
+
+        return metric
+
+    def counter(self, name, documentation, labels=(), *, function=None):
+        return self._register(Counter, name, documentation, labels, function=function)
+
+    def gauge(self, name, documentation, labels=(), *, function=None):
+        return self._register(Gauge, name, documentation, labels, function=function)
+
+    def histogram(self, name, documentation, labels=(), *, buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram, name, documentation, labels, buckets=buckets)
+
+    def render(self):
+        return "\n".join(metric.render() for metric in self.metrics.values()) + "\n"
+
+class MetricsServer:
+    def __init__(self, registry, *, host="127.0.0.1", port):
+        self.registry = registry
+        self.host = host
+        self.port = port
+
+        self.app = web.Application()
+        self.app.router.add_get("/metrics", self.handle_metrics)
+        self.runner = None
+
+    async def start(self):
+        self.runner = web.AppRunner(self.app, access_log=None)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, self.host, self.port).start()
+        log.info("Serving metrics on http://%s:%s/metrics.", self.host, self.port)
+
+    async def close(self):
+        if self.runner:
+            await self.runner.cleanup()
+
+    async def handle_metrics(self, request):
+        return web.Response(text=self.registry.render(), headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
@@ -0,0 +1,135 @@
+import asyncio
+import collections
+import datetime
+import heapq
+import itertools
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+
+log = logging.getLogger("robo_coder.monitor")
+
+class SlowCallback:
+    __slots__ = ("duration", "occurred_at", "stack", "location")
+
+    def __init__(self, duration, stack):
+        self.duration = duration
+        self.occurred_at = datetime.datetime.now(datetime.UTC)
+        self.stack = stack
+        self.location = self.find_location(stack)
+
+    @staticmethod
+    def find_location(stack):
+        # The innermost frame from our own code is usually the culprit, not the library it called into
+        root = os.getcwd()
+        for frame in reversed(stack):
+            if frame.filename.startswith(root) and "site-packages" not in frame.filename:
+                return f"{os.path.relpath(frame.filename, root)}:{frame.lineno} in {frame.name}"
+
+        if stack:
+            return f"{os.path.basename(stack[-1].filename)}:{stack[-1].lineno} in {stack[-1].name}"
+        return "unknown"
+
+    def format_stack(self):
+        return "".join(traceback.format_list(self.stack))
+
+class LoopMonitor:
+    """Measures event loop lag and captures the stack of anything that blocks the loop.
+
+    A task on the loop wakes up every interval and records how late it was. A watchdog
+    thread notices when that task hasn't run for longer than the threshold and grabs the
+    loop thread's stack while it's still stuck, so we can see what was blocking it.
+    """
+
+    def __init__(self, loop, *, interval=0.1, threshold=0.25, max_offenders=10, on_slow_callback=None):
+        self.loop = loop
+        self.interval = interval
+        self.threshold = threshold
+        self.max_offenders = max_offenders
+        self.on_slow_callback = on_slow_callback
+
+        self.lags = collections.deque(maxlen=round(60 / interval))
+        self.max_lag = 0
+        self.slow_callbacks = 0
+
+        self._offenders = []
+        self._counter = itertools.count()
+        self._last_beat = None
+        self._stall = None
+        self._thread_id = None
+        self._task = None
+        self._thread = None
+        self._closed = threading.Event()
+
+    @property
+    def lag(self):
+        return self.lags[-1] if self.lags else 0
+
+    @property
+    def average_lag(self):
+        return sum(self.lags) / len(self.lags) if self.lags else 0
+
+    @property
+    def offenders(self):
+        return [offender for _, _, offender in sorted(self._offenders, reverse=True)]
+
+    def start(self):
+        # Must be called from the loop's thread so the watchdog knows whose stack to capture
+        self._thread_id = threading.get_ident()
+        self._last_beat = time.perf_counter()
+        self._task = self.loop.create_task(self._beat())
+
+        self._thread = threading.Thread(target=self._watch, name="loop-monitor", daemon=True)
+        self._thread.start()
+
+    def close(self):
+        self._closed.set()
+        if self._task:
+            self._task.cancel()
+
+    async def _beat(self):
+        while True:
+            before = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            now = time.perf_counter()
+
+            lag = max(now - before - self.interval, 0)
+            self.lags.append(lag)
+            self.max_lag = max(self.max_lag, lag)
+
+            stall, self._stall = self._stall, None
+            self._last_beat = now
+
+            if lag >= self.threshold:
+                self.slow_callbacks += 1
+                self.record(SlowCallback(lag, stall[1] if stall else []))
+
+    def _watch(self):
+        while not self._closed.wait(self.threshold / 4):
+            beat = self._last_beat
+            if (self._stall is None or self._stall[0] != beat) and time.perf_counter() - beat > self.interval + self.threshold:
+                frame = sys._current_frames().get(self._thread_id)
+                if frame is not None:
+                    self._stall = (beat, traceback.extract_stack(frame, limit=20))
+
+    def record(self, offender):
+        log.warning("Event loop was blocked for %.0fms at %s.", offender.duration * 1000, offender.location)
+
+        # Only the worst offenders are kept, so the smallest one is evicted when the buffer is full
+        entry = (offender.duration, next(self._counter), offender)
+        if len(self._offenders) < self.max_offenders:
+            heapq.heappush(self._offenders, entry)
+        elif offender.duration > self._offenders[0][0]:
+            heapq.heapreplace(self._offenders, entry)
+
+        if self.on_slow_callback is not None:
+            self.on_slow_callback(offender)
+
+    def clear(self):
+        self._offenders.clear()
+        self.lags.clear()
+        self.max_lag = 0
+        self.slow_callbacks = 0
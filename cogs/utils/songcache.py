@@ -0,0 +1,259 @@
+import asyncio
+import collections
+import logging
+import os
+import time
+
+log = logging.getLogger("robo_coder.songcache")
+
+class CachedSong:
+    __slots__ = ("filename", "size", "last_played", "plays")
+
+    def __init__(self, filename, size, last_played, plays=0):
+        self.filename = filename
+        self.size = size
+        self.last_played = last_played
+        self.plays = plays
+
+class SongCache:
+    """An in-memory manifest of the downloaded songs, kept under a size budget by evicting the least used ones."""
+
+    def __init__(self, directory="songs", *, max_size=None, orphan_age=3600, sample=8):
+        self.directory = directory
+        self.max_size = max_size
+        self.orphan_age = orphan_age
+        self.sample = sample
+
+        # Only one process should delete files, the others just keep their manifests in sync
+        self.evicts = True
+        self.on_change = None
+
+        # Coroutine returning the filenames that are playing or queued on any cluster, which are never evicted
+        self.in_use = None
+
+        self.size = 0
+        self.evictions = 0
+        self.ready = False
+
+        # Least recently played first
+        self._entries = collections.OrderedDict()
+
+        # Files that were just added, kept until the next eviction has seen them as in use
+        self._keep = set()
+        self._evicting = None
+
+        # Files that were removed but might still be playing somewhere, deleted once nothing uses them
+        self._removed = set()
+
+    def __contains__(self, filename):
+        # Until the manifest is loaded the disk is the only thing that knows
+        if not self.ready:
+            return os.path.exists(filename)
+        return filename in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, filename):
+        return self._entries.get(filename)
+
+    async def reconcile(self, db):
+        records = await db.fetch("SELECT filename, plays FROM songs;")
+        plays = {record["filename"]: record["plays"] or 0 for record in records}
+
+        loop = asyncio.get_running_loop()
+        files = await loop.run_in_executor(None, self._scan)
+
+        now = time.time()
+        entries = []
+        orphans = []
+
+        for filename, size, modified_at in files:
+            if filename in plays:
+                # Nothing records when a song was last played, so the file's age is the best guess
+                entries.append(CachedSong(filename, size, modified_at, plays[filename]))
+            elif now - modified_at > self.orphan_age:
+                # Recent files might still be downloading (or about to be added to the database)
+                orphans.append(filename)
+
+        entries.sort(key=lambda entry: entry.last_played)
+        manifest = collections.OrderedDict((entry.filename, entry) for entry in entries)
+
+        # Anything downloaded while we were scanning is newer than what's on disk
+        for filename, entry in self._entries.items():
+            manifest.pop(filename, None)
+            manifest[filename] = entry
+
+        self._entries = manifest
+        self.size = sum(entry.size for entry in manifest.values())
+        self.ready = True
+
+        log.info("Song cache has %s files (%s bytes). Found %s orphaned files.", len(self._entries), self.size, len(orphans))
+
+        if self.evicts:
+            if orphans:
+                await loop.run_in_executor(None, self._delete, orphans)
+            self.evict()
+
+    def _scan(self):
+        if not os.path.isdir(self.directory):
+            return []
+
+        files = []
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                if entry.is_file():
+                    stat = entry.stat()
+                    files.append((os.path.join(self.directory, entry.name), stat.st_size, stat.st_mtime))
+
+        return files
+
+    def add(self, filename, size=None, *, notify=True):
+        if size is None:
+            try:
+                size = os.path.getsize(filename)
+            except OSError:
+                return
+
+        entry = self._entries.pop(filename, None)
+        if entry is not None:
+            self.size -= entry.size
+            entry.size = size
+            entry.last_played = time.time()
+        else:
+            entry = CachedSong(filename, size, time.time())
+
+        self._entries[filename] = entry
+        self.size += size
+
+        # Downloaded again after it was removed, so it's not going anywhere
+        self._removed.discard(filename)
+
+        if notify and self.on_change is not None:
+            self.on_change("add", filename, size)
+
+        # The file that was just downloaded is about to be played, so it can't be what goes
+        self.evict(keep=filename)
+
+    def played(self, filename, *, notify=True):
+        entry = self._entries.get(filename)
+        if entry is None:
+            return
+
+        entry.plays += 1
+        entry.last_played = time.time()
+        self._entries.move_to_end(filename)
+
+        if notify and self.on_change is not None:
+            self.on_change("play", filename, None)
+
+    def discard(self, filename, *, notify=True):
+        # Forgets a file without deleting it, for when it's already gone
+        entry = self._entries.pop(filename, None)
+        if entry is None:
+            return
+
+        self.size -= entry.size
+
+        if notify and self.on_change is not None:
+            self.on_change("remove", filename, None)
+
+    def remove(self, filename, *, notify=True):
+        # Forgets a file right away, but it's only deleted once no cluster is playing or queueing it
+        self.discard(filename, notify=False)
+
+        if notify and self.on_change is not None:
+            self.on_change("delete", filename, None)
+
+        if self.evicts:
+            self._removed.add(filename)
+            self._start_evicting()
+
+    def apply(self, op, filename, size):
+        # Applies a change made by another process without announcing it again
+        if op == "add":
+            self.add(filename, size, notify=False)
+        elif op == "play":
+            self.played(filename, notify=False)
+        elif op == "remove":
+            self.discard(filename, notify=False)
+        elif op == "delete":
+            self.remove(filename, notify=False)
+
+    def evict(self, *, keep=None):
+        if not self.evicts or self.max_size is None or self.size <= self.max_size:
+            # Removed files that were in use last time might not be anymore
+            if self.evicts and self._removed:
+                self._start_evicting()
+            return
+
+        if keep is not None:
+            self._keep.add(keep)
+        self._start_evicting()
+
+    def _start_evicting(self):
+        # Finding out what's in use means asking the other clusters, so only one eviction runs at a time
+        if self._evicting is None or self._evicting.done():
+            self._evicting = asyncio.get_running_loop().create_task(self._evict())
+
+    async def _evict(self):
+        keep = self._keep
+        self._keep = set()
+
+        in_use = set()
+        if self.in_use is not None:
+            try:
+                in_use = await self.in_use()
+            except Exception as exc:
+                log.warning("Couldn't find out which songs are in use, not evicting anything.", exc_info=exc)
+                return
+            if in_use is None:
+                # Some cluster didn't answer, and it might be playing anything
+                log.warning("Not every cluster said which songs are in use, not evicting anything.")
+                return
+
+        in_use |= keep
+
+        removed = self._removed - in_use
+        self._removed -= removed
+        if removed:
+            log.info("Deleting %s removed files from the song cache.", len(removed))
+            await asyncio.get_running_loop().run_in_executor(None, self._delete, removed)
+
+        evicted = []
+        while self.max_size is not None and self.size > self.max_size:
+            entry = self._pick_victim(in_use)
+            if entry is None:
+                log.warning("Song cache is over its budget but every file is in use.")
+                break
+
+            self.discard(entry.filename)
+            self.evictions += 1
+            evicted.append(entry.filename)
+
+        if evicted:
+            log.info("Evicting %s files from the song cache.", len(evicted))
+            await asyncio.get_running_loop().run_in_executor(None, self._delete, evicted)
+
+    def _pick_victim(self, in_use):
+        # Out of the few least recently played songs, the one played the least goes first,
+        # so a popular song that hasn't come up in a while outlives one that was played once
+        candidates = []
+        for entry in self._entries.values():
+            if entry.filename in in_use:
+                continue
+
+            candidates.append(entry)
+            if len(candidates) >= self.sample:
+                break
+
+        return min(candidates, key=lambda entry: entry.plays, default=None)
+
+    def _delete(self, filenames):
+        for filename in filenames:
+            try:
+                os.remove(filename)
+            except FileNotFoundError:
+                pass
+            except OSError as exc:
+                log.warning("Failed to delete %s from the song cache.", filename, exc_info=exc)
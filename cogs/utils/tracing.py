@@ -0,0 +1,209 @@
+import collections
+import concurrent.futures
+import contextlib
+import contextvars
+import datetime
+import functools
+import json
+import logging
+import logging.handlers
+import secrets
+import time
+
+import aiohttp
+
+log = logging.getLogger("robo_coder.tracing")
+
+# The span that new spans become children of. Tasks copy the context they were created in,
+# so anything awaited (or spawned) while a span is open ends up in the same trace.
+current_span = contextvars.ContextVar("current_span", default=None)
+
+class Span:
+    __slots__ = ("trace", "name", "span_id", "parent_id", "started_at", "start", "duration", "attributes", "error")
+
+    def __init__(self, trace, name, parent_id=None, **attributes):
+        self.trace = trace
+        self.name = name
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent_id
+        self.started_at = datetime.datetime.now(datetime.UTC)
+        self.start = time.perf_counter()
+        self.duration = None
+        self.attributes = attributes
+        self.error = None
+
+    @property
+    def offset(self):
+        return self.start - self.trace.root.start
+
+    def finish(self, error=None):
+        self.duration = time.perf_counter() - self.start
+        if error is not None:
+            self.error = f"{type(error).__name__}: {error}"
+
+    def to_dict(self):
+        return {
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "offset": round(self.offset, 6),
+            "duration": round(self.duration, 6) if self.duration is not None else None,
+            "attributes": self.attributes,
+            "error": self.error
+        }
+
+class Trace:
+    __slots__ = ("trace_id", "root", "spans", "finished")
+
+    # Background tasks started during a command inherit its context, so this keeps a long
+    # running task like a player loop from growing the trace forever
+    max_spans = 500
+
+    def __init__(self, name, **attributes):
+        self.trace_id = secrets.token_hex(16)
+        self.root = Span(self, name, **attributes)
+        self.spans = [self.root]
+        self.finished = False
+
+    @property
+    def name(self):
+        return self.root.name
+
+    @property
+    def duration(self):
+        return self.root.duration
+
+    def start_span(self, name, parent, **attributes):
+        if self.finished or len(self.spans) >= self.max_spans:
+            return None
+
+        span = Span(self, name, parent.span_id, **attributes)
+        self.spans.append(span)
+        return span
+
+    def to_dict(self):
+        return {
+            "trace_id": self.trace_id,
+            "name": self.name,
+            "started_at": self.root.started_at.isoformat(),
+            "duration": round(self.duration, 6),
+            "spans": [span.to_dict() for span in self.spans]
+        }
+
+def start_span(name, **attributes):
+    # Starts a child of the current span without making it current, for callbacks that can't use a with block
+    parent = current_span.get()
+    if parent is None:
+        return None
+
+    return parent.trace.start_span(name, parent, **attributes)
+
+@contextlib.contextmanager
+def span(name, **attributes):
+    # Does nothing unless something further up opened a trace
+    child = start_span(name, **attributes)
+    if child is None:
+        yield None
+        return
+
+    token = current_span.set(child)
+    try:
+        yield child
+    except BaseException as exc:
+        child.finish(exc)
+        raise
+    else:
+        child.finish()
+    finally:
+        current_span.reset(token)
+
+class TracingExecutor(concurrent.futures.ThreadPoolExecutor):
+    """Default executor that records a span for work submitted while a trace is open."""
+
+    def submit(self, fn, /, *args, **kwargs):
+        child = start_span("executor", function=getattr(fn, "__qualname__", None) or getattr(getattr(fn, "func", None), "__qualname__", repr(fn)))
+        future = super().submit(fn, *args, **kwargs)
+
+        if child is not None:
+            future.add_done_callback(lambda future: child.finish(None if future.cancelled() else future.exception()))
+
+        return future
+
+def trace_config():
+    # Records a span for every request made through a session this is added to
+    async def on_request_start(session, context, params):
+        context.span = start_span("http", method=params.method, url=str(params.url.with_query(None)))
+
+    async def on_request_end(session, context, params):
+        if context.span is not None:
+            context.span.attributes["status"] = params.response.status
+            context.span.finish()
+
+    async def on_request_exception(session, context, params):
+        if context.span is not None:
+            context.span.finish(params.exception)
+
+    config = aiohttp.TraceConfig()
+    config.on_request_start.append(on_request_start)
+    config.on_request_end.append(on_request_end)
+    config.on_request_exception.append(on_request_exception)
+    return config
+
+def traced(name, func):
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        with span(name):
+            return await func(*args, **kwargs)
+
+    return wrapper
+
+class Tracer:
+    def __init__(self, *, filename=None, max_traces=200, max_bytes=50 * 1024 * 1024, backup_count=3):
+        self.filename = filename
+        self.traces = collections.deque(maxlen=max_traces)
+
+        # Traces are written by their own thread so the file never blocks the loop (or shows up in traces)
+        self._writer = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="tracing")
+
+        # The bot runs for weeks, so the file is rolled over instead of growing forever
+        self._handler = None
+        if filename is not None:
+            self._handler = logging.handlers.RotatingFileHandler(filename, maxBytes=max_bytes, backupCount=backup_count, delay=True)
+
+    @contextlib.contextmanager
+    def trace(self, name, **attributes):
+        trace = Trace(name, **attributes)
+        token = current_span.set(trace.root)
+
+        try:
+            yield trace
+        except BaseException as exc:
+            trace.root.finish(exc)
+            raise
+        else:
+            trace.root.finish()
+        finally:
+            current_span.reset(token)
+            trace.finished = True
+            self.record(trace)
+
+    def record(self, trace):
+        self.traces.append(trace)
+
+        if self.filename is not None:
+            self._writer.submit(self._write, json.dumps(trace.to_dict()))
+
+    def _write(self, line):
+        # The handler reports its own errors, and the default formatter writes the message as is
+        self._handler.handle(logging.makeLogRecord({"msg": line, "levelno": logging.INFO}))
+
+    def slowest(self, limit=10):
+        return sorted(self.traces, key=lambda trace: trace.duration, reverse=True)[:limit]
+
+    def get(self, trace_id):
+        return next((trace for trace in self.traces if trace.trace_id.startswith(trace_id)), None)
+
+    def close(self):
+        self._writer.shutdown(wait=True)
+        if self._handler is not None:
+            self._handler.close()
@@ -0,0 +1,186 @@
+import asyncio
+import logging
+import multiprocessing
+import time
+
+import yt_dlp
+
+log = logging.getLogger("robo_coder.ytdl")
+
+class WorkerError(Exception):
+    pass
+
+def _worker_main(connection, options):
+    # Runs in the worker process, which keeps its own YoutubeDL for as long as it lives
+    ytdl = yt_dlp.YoutubeDL(options)
+    flat_ytdl = None
+
+    while True:
+        try:
+            method, args, kwargs = connection.recv()
+        except EOFError:
+            return
+
+        try:
+            if method == "extract_info":
+                # Only plain data can be sent back, and extract_info can return lazy lists and the like
+                result = ytdl.sanitize_info(ytdl.extract_info(*args, **kwargs))
+            elif method == "extract_flat":
+                # Lists a playlist's entries without resolving each of them, which is what makes playlists slow
+                if flat_ytdl is None:
+                    flat_ytdl = yt_dlp.YoutubeDL({**options, "extract_flat": "in_playlist"})
+                result = flat_ytdl.sanitize_info(flat_ytdl.extract_info(*args, download=False, **kwargs))
+            elif method == "process_info":
+                ytdl.process_info(*args, **kwargs)
+                result = None
+            else:
+                raise ValueError(f"Unknown method {method}")
+        except yt_dlp.DownloadError as exc:
+            connection.send(("download_error", str(exc)))
+        except Exception as exc:
+            connection.send(("error", f"{type(exc).__name__}: {exc}"))
+        else:
+            connection.send(("ok", result))
+
+class Worker:
+    __slots__ = ("process", "connection")
+
+    def __init__(self, context, options):
+        self.connection, child = context.Pipe()
+        self.process = context.Process(target=_worker_main, args=(child, options), daemon=True)
+        self.process.start()
+        child.close()
+
+    def kill(self):
+        self.process.kill()
+        self.connection.close()
+
+        # Reaped off the loop, killed processes exit almost immediately anyways
+        asyncio.get_running_loop().run_in_executor(None, self.process.join)
+
+class WorkerPool:
+    """Runs yt-dlp in worker processes, so jobs can actually be stopped when they're cancelled or time out."""
+
+    def __init__(self, options, *, size=3, metrics=None):
+        self.options = options
+        self.size = size
+
+        # Playlists can take minutes, so they're never allowed to take up every worker
+        self._heavy = asyncio.Semaphore(max(size - 1, 1))
+
+        # Spawned instead of forked, since forking a process with a running loop and threads isn't safe
+        self._context = multiprocessing.get_context("spawn")
+        self._queue = asyncio.Queue()
+        self._tasks = []
+        self.busy = 0
+
+        self.durations = None
+        self.waits = None
+
+        if metrics is not None:
+            metrics.gauge("ytdl_queue_depth", "yt-dlp jobs waiting for a worker", function=lambda: self._queue.qsize())
+            metrics.gauge("ytdl_busy_workers", "yt-dlp workers running a job", function=lambda: self.busy)
+            self.durations = metrics.histogram("ytdl_job_duration_seconds", "Time yt-dlp jobs spent running, by method and outcome", ["method", "status"], buckets=(0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 180))
+            self.waits = metrics.histogram("ytdl_queue_wait_seconds", "Time yt-dlp jobs spent waiting for a worker", buckets=(0.01, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60))
+
+    def start(self):
+        loop = asyncio.get_running_loop()
+        self._tasks = [loop.create_task(self._run()) for _ in range(self.size)]
+
+    async def close(self):
+        for task in self._tasks:
+            task.cancel()
+
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def run(self, method, *args, heavy=False, timeout=None, **kwargs):
+        if heavy:
+            async with self._heavy:
+                return await self._submit(method, args, kwargs, timeout)
+
+        return await self._submit(method, args, kwargs, timeout)
+
+    async def _submit(self, method, args, kwargs, timeout):
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((method, args, kwargs, future, time.perf_counter()))
+
+        # Cancelling (or timing out) cancels the future, and the worker running it is killed
+        return await asyncio.wait_for(future, timeout=timeout)
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        worker = None
+        result = None
+
+        try:
+            while True:
+                method, args, kwargs, future, queued_at = await self._queue.get()
+                if future.done():
+                    # Whoever submitted this gave up while it was waiting
+                    continue
+
+                if self.waits is not None:
+                    self.waits.observe(time.perf_counter() - queued_at)
+
+                if worker is None:
+                    worker = Worker(self._context, self.options)
+
+                self.busy += 1
+                started_at = time.perf_counter()
+
+                try:
+                    worker.connection.send((method, args, kwargs))
+                except OSError:
+                    # The worker died while it was idle
+                    result = loop.create_future()
+                    result.set_result(("dead", "The yt-dlp worker exited unexpectedly"))
+                else:
+                    # Results can be far bigger than the pipe's buffer, so they're read off the loop
+                    result = loop.run_in_executor(None, self._receive, worker)
+
+                try:
+                    await asyncio.wait([future, result], return_when=asyncio.FIRST_COMPLETED)
+
+                    if not result.done():
+                        # yt-dlp has no way to stop partway through, so the process goes with it.
+                        # The connection is only closed once the read that's waiting on it has given up.
+                        log.info("Killing yt-dlp worker running a cancelled %s job.", method)
+                        worker.process.kill()
+                        await asyncio.wait([result])
+                        worker.kill()
+                        worker = None
+                        status = "cancelled"
+                    else:
+                        status, value = result.result()
+                        if status == "dead":
+                            log.warning("yt-dlp worker exited unexpectedly with code %s.", worker.process.exitcode)
+                            worker.kill()
+                            worker = None
+                finally:
+                    self.busy -= 1
+
+                if status != "cancelled" and not future.done():
+                    if status == "ok":
+                        future.set_result(value)
+                    elif status == "download_error":
+                        future.set_exception(yt_dlp.DownloadError(value))
+                    else:
+                        future.set_exception(WorkerError(value))
+
+                if self.durations is not None:
+                    self.durations.observe(time.perf_counter() - started_at, method=method, status=status)
+        finally:
+            if worker is not None:
+                # Same as cancelling a job, the read has to give up before the connection can be closed
+                worker.process.kill()
+                if result is not None and not result.done():
+                    await asyncio.wait([result])
+                worker.kill()
+
+    def _receive(self, worker):
+        # Runs in a thread until the worker answers or its process exits
+        try:
+            return worker.connection.recv()
+        except (EOFError, OSError):
+            return ("dead", "The yt-dlp worker exited unexpectedly")
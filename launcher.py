@@ -0,0 +1,108 @@
+import asyncio
+import logging
+import math
+import os
+import secrets
+import signal
+import sys
+
+import aiohttp
+
+import config
+from cogs.utils import ipc
+
+log = logging.getLogger("robo_coder.launcher")
+logging.basicConfig(level=logging.INFO, format="(%(asctime)s) %(levelname)s %(message)s", datefmt="%m/%d/%y - %H:%M:%S %Z")
+
+
+async def get_recommended_shard_count():
+    headers = {"Authorization": f"Bot {config.token}"}
+    async with aiohttp.ClientSession() as session:
+        async with session.get("https://discord.com/api/v10/gateway/bot", headers=headers) as resp:
+            resp.raise_for_status()
+            data = await resp.json()
+            return data["shards"]
+
+
+class Cluster:
+    def __init__(self, launcher, cluster_id, shard_ids):
+        self.launcher = launcher
+        self.cluster_id = cluster_id
+        self.shard_ids = shard_ids
+        self.process = None
+
+    def __str__(self):
+        return f"cluster {self.cluster_id} (shards {self.shard_ids[0]}-{self.shard_ids[-1]})"
+
+    async def start(self):
+        env = os.environ.copy()
+        env.update({
+            "ROBO_CODER_CLUSTER_ID": str(self.cluster_id),
+            "ROBO_CODER_CLUSTER_COUNT": str(len(self.launcher.clusters)),
+            "ROBO_CODER_SHARD_IDS": ",".join(str(shard_id) for shard_id in self.shard_ids),
+            "ROBO_CODER_SHARD_COUNT": str(self.launcher.shard_count),
+            "ROBO_CODER_IPC_PORT": str(self.launcher.hub.port),
+            "ROBO_CODER_IPC_SECRET": self.launcher.hub.secret
+        })
+
+        log.info("Starting %s.", self)
+        self.process = await asyncio.create_subprocess_exec(sys.executable, "bot.py", env=env)
+
+    async def run(self):
+        while True:
+            await self.start()
+            returncode = await self.process.wait()
+
+            if self.launcher.closing:
+                return
+
+            log.warning("%s exited with code %s. Restarting in 5 seconds.", self, returncode)
+            await asyncio.sleep(5)
+
+    def stop(self):
+        if self.process and self.process.returncode is None:
+            log.info("Stopping %s.", self)
+            self.process.send_signal(signal.SIGINT)
+
+
+class Launcher:
+    def __init__(self):
+        self.shard_count = getattr(config, "shard_count", None)
+        self.cluster_count = getattr(config, "cluster_count", None) or os.cpu_count()
+        self.hub = ipc.Hub(port=getattr(config, "ipc_port", 4000), secret=secrets.token_hex(16))
+
+        self.clusters = []
+        self.closing = False
+
+    async def run(self):
+        if self.shard_count is None:
+            self.shard_count = await get_recommended_shard_count()
+
+        # Each cluster gets a contiguous range of shards
+        cluster_count = min(self.cluster_count, self.shard_count)
+        per_cluster = math.ceil(self.shard_count / cluster_count)
+        shard_ids = list(range(self.shard_count))
+
+        for cluster_id, start in enumerate(range(0, self.shard_count, per_cluster)):
+            self.clusters.append(Cluster(self, cluster_id, shard_ids[start:start + per_cluster]))
+
+        log.info("Launching %s cluster(s) for %s shard(s).", len(self.clusters), self.shard_count)
+        await self.hub.start()
+
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, self.close)
+
+        try:
+            await asyncio.gather(*[cluster.run() for cluster in self.clusters])
+        finally:
+            await self.hub.close()
+
+    def close(self):
+        self.closing = True
+        for cluster in self.clusters:
+            cluster.stop()
+
+
+if __name__ == "__main__":
+    asyncio.run(Launcher().run())
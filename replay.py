@@ -0,0 +1,415 @@
+"""Replays gateway events into the bot without connecting to Discord.
+
+The bot runs its real setup_hook against a local Postgres, while Discord's HTTP API
+is replaced by a local stand-in that accepts every request. Events are either
+synthetic or read from a JSON-lines file of gateway dispatches ({"t": ..., "d": ...}).
+
+    python replay.py --database-uri postgresql://localhost/robo_coder_replay --events 20000
+    python replay.py --database-uri ... --file events.jsonl --json results.json
+    python replay.py --database-uri ... --compare results.json
+
+Use a throwaway database, since the synthetic run seeds it with guild settings.
+"""
+
+import argparse
+import asyncio
+import gc
+import itertools
+import json
+import logging
+import os
+import random
+import sys
+import time
+import tracemalloc
+import types
+
+import discord
+from aiohttp import web
+
+from bot import RoboCoder
+
+log = logging.getLogger("robo_coder.replay")
+
+GUILD_ID = 700000000000000000
+CHANNEL_ID = 700000000000000001
+LOG_CHANNEL_ID = 700000000000000002
+BOT_ID = 700000000000000010
+OWNER_ID = 700000000000000011
+USER_IDS = range(710000000000000000, 710000000000000200)
+
+def snowflake():
+    # Message IDs carry their creation time, which cooldowns and spam detection depend on
+    return discord.utils.time_snowflake(discord.utils.utcnow()) + random.randrange(1 << 22)
+
+def user_payload(user_id, *, bot=False):
+    return {"id": str(user_id), "username": f"user{user_id % 1000}", "discriminator": "0", "global_name": None, "avatar": None, "bot": bot}
+
+def member_payload(user_id, *, bot=False):
+    return {"user": user_payload(user_id, bot=bot), "roles": [], "joined_at": "2020-01-01T00:00:00+00:00", "deaf": False, "mute": False, "flags": 0}
+
+def guild_payload():
+    return {
+        "id": str(GUILD_ID),
+        "name": "Replay",
+        "owner_id": str(OWNER_ID),
+        "member_count": len(USER_IDS) + 2,
+        "roles": [{"id": str(GUILD_ID), "name": "@everyone", "permissions": str(discord.Permissions.general().value | discord.Permissions.text().value), "position": 0, "color": 0, "hoist": False, "managed": False, "mentionable": False}],
+        "channels": [
+            {"id": str(CHANNEL_ID), "type": 0, "name": "general", "position": 0, "permission_overwrites": []},
+            {"id": str(LOG_CHANNEL_ID), "type": 0, "name": "logs", "position": 1, "permission_overwrites": []}
+        ],
+        "members": [member_payload(BOT_ID, bot=True), member_payload(OWNER_ID)] + [member_payload(user_id) for user_id in USER_IDS],
+        "emojis": [],
+        "stickers": [],
+        "features": [],
+        "threads": [],
+        "voice_states": []
+    }
+
+def message_payload(author_id, content):
+    return {
+        "id": str(snowflake()),
+        "type": 0,
+        "channel_id": str(CHANNEL_ID),
+        "guild_id": str(GUILD_ID),
+        "author": user_payload(author_id),
+        "member": {key: value for key, value in member_payload(author_id).items() if key != "user"},
+        "content": content,
+        "timestamp": discord.utils.utcnow().isoformat(),
+        "edited_timestamp": None,
+        "tts": False,
+        "mention_everyone": False,
+        "mentions": [],
+        "mention_roles": [],
+        "attachments": [],
+        "embeds": [],
+        "pinned": False
+    }
+
+def synthetic_events(count):
+    # A rough mix of real traffic: mostly chatter, some commands, reactions and deletes
+    sent = []
+    spammer = USER_IDS[0]
+
+    for index in range(count):
+        kind = random.random()
+
+        if kind < 0.55 or not sent:
+            payload = message_payload(random.choice(USER_IDS[1:]), random.choice(["hello", "what's up", "lol", "https://example.com", "ok :)"]))
+            sent.append(payload)
+            yield "MESSAGE_CREATE", payload
+        elif kind < 0.7:
+            payload = message_payload(random.choice(USER_IDS[1:]), random.choice(["r!ping", "r!uptime", "r!support", "r!prefix", "r!notacommand"]))
+            yield "MESSAGE_CREATE", payload
+        elif kind < 0.8:
+            # One user repeats themselves so the spam detector eventually acts
+            yield "MESSAGE_CREATE", message_payload(spammer, "buy my stuff")
+        elif kind < 0.92:
+            message = random.choice(sent)
+            yield "MESSAGE_REACTION_ADD", {
+                "user_id": str(random.choice(USER_IDS[1:])),
+                "channel_id": str(CHANNEL_ID),
+                "message_id": message["id"],
+                "guild_id": str(GUILD_ID),
+                "emoji": {"id": None, "name": "\N{THUMBS UP SIGN}"},
+                "member": member_payload(random.choice(USER_IDS[1:])),
+                "type": 0
+            }
+        else:
+            message = sent.pop(random.randrange(len(sent)))
+            yield "MESSAGE_DELETE", {"id": message["id"], "channel_id": str(CHANNEL_ID), "guild_id": str(GUILD_ID)}
+
+def recorded_events(filename):
+    with open(filename) as file:
+        for line in file:
+            if line.strip():
+                event = json.loads(line)
+                yield event["t"], event["d"]
+
+def json_response(data):
+    # discord.py only decodes responses whose content type is exactly application/json
+    return web.Response(body=json.dumps(data).encode(), headers={"Content-Type": "application/json"})
+
+class DiscordStandIn:
+    """Accepts every request the bot makes to Discord's HTTP API."""
+
+    def __init__(self):
+        self.requests = 0
+        self.app = web.Application()
+        self.app.router.add_get("/api/v10/users/@me", self.get_user)
+        self.app.router.add_get("/api/v10/oauth2/applications/@me", self.get_application)
+        self.app.router.add_post("/api/v10/channels/{channel_id}/messages", self.create_message)
+        self.app.router.add_route("*", "/{path:.*}", self.fallback)
+        self.runner = None
+
+    async def start(self):
+        self.runner = web.AppRunner(self.app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, "127.0.0.1", 0)
+        await site.start()
+        return site._server.sockets[0].getsockname()[1]
+
+    async def close(self):
+        await self.runner.cleanup()
+
+    async def get_user(self, request):
+        self.requests += 1
+        return json_response(user_payload(BOT_ID, bot=True))
+
+    async def get_application(self, request):
+        self.requests += 1
+        return json_response({
+            "id": str(BOT_ID),
+            "name": "Robo Coder",
+            "icon": None,
+            "description": "",
+            "rpc_origins": [],
+            "bot_public": True,
+            "bot_require_code_grant": False,
+            "owner": user_payload(OWNER_ID),
+            "summary": "",
+            "verify_key": "",
+            "flags": 0
+        })
+
+    async def create_message(self, request):
+        self.requests += 1
+        data = await request.json() if request.content_type == "application/json" else {}
+        payload = message_payload(BOT_ID, data.get("content") or "")
+        payload.update(channel_id=request.match_info["channel_id"], author=user_payload(BOT_ID, bot=True), embeds=data.get("embeds") or [])
+        return json_response(payload)
+
+    async def fallback(self, request):
+        self.requests += 1
+        if request.method in ("DELETE", "PUT"):
+            return web.Response(status=204)
+        return json_response({})
+
+class ReplayBot(RoboCoder):
+    def __init__(self, options):
+        self.options = options
+        self.errors = 0
+
+        # Replaces the config module, and has to be set before the bot reads anything from it
+        self.config = types.SimpleNamespace(
+            token="replay",
+            database_uri=options.database_uri,
+            console_webhook_url=None,
+            logging_guild_ids=[GUILD_ID],
+            trace_file=None,
+            github_token=None
+        )
+
+        super().__init__()
+        self._connection._chunk_guilds = False
+        self._tasks = None
+
+    async def setup_hook(self):
+        await super().setup_hook()
+
+        # Synthetic users will trip the global cooldown, which must not leak into the real config files
+        self.prefixes.persist = self.blacklist.persist = False
+        self.owner_id = OWNER_ID
+
+    def _schedule_event(self, coro, event_name, *args, **kwargs):
+        task = super()._schedule_event(coro, event_name, *args, **kwargs)
+        if self._tasks is not None:
+            self._tasks.append(task)
+        return task
+
+    async def on_error(self, event, *args, **kwargs):
+        self.errors += 1
+        if self.errors == 1:
+            log.exception("Exception in %s while replaying (further errors are only counted).", event)
+
+    async def replay(self, name, data):
+        # Runs the parser for an event and waits for every handler it dispatched to finish
+        self._tasks = tasks = []
+        started_at = time.perf_counter()
+        self._connection.parsers[name](data)
+        self._tasks = None
+
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+        return time.perf_counter() - started_at
+
+def percentile(values, percentile):
+    if not values:
+        return 0
+    return values[min(int(len(values) * percentile / 100), len(values) - 1)]
+
+def summarize(latencies):
+    latencies = sorted(latencies)
+    return {
+        "count": len(latencies),
+        "p50_ms": round(percentile(latencies, 50) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 3),
+        "max_ms": round(latencies[-1] * 1000, 3) if latencies else 0
+    }
+
+async def seed_database(bot):
+    query = """INSERT INTO guild_config (guild_id, mute_role_id, muted, spam_prevention, ignore_spam_channels, log_channel_id)
+               VALUES ($1, NULL, '{}', TRUE, '{}', NULL)
+               ON CONFLICT (guild_id) DO UPDATE
+               SET spam_prevention=TRUE;
+            """
+    await bot.db.execute(query, GUILD_ID)
+
+    query = """INSERT INTO message_logs (guild_id, channel_id)
+               VALUES ($1, $2)
+               ON CONFLICT (guild_id) DO UPDATE
+               SET channel_id=$2;
+            """
+    await bot.db.execute(query, GUILD_ID, LOG_CHANNEL_ID)
+
+async def run(options):
+    stand_in = DiscordStandIn()
+    port = await stand_in.start()
+    discord.http.Route.BASE = f"http://127.0.0.1:{port}/api/v10"
+
+    bot = ReplayBot(options)
+
+    async with bot:
+        await bot.login(bot.config.token)
+
+        if options.file:
+            events = list(recorded_events(options.file))
+        else:
+            await seed_database(bot)
+            events = list(synthetic_events(options.events))
+
+        for name, data in [event for event in events if event[0] == "GUILD_CREATE"] or [("GUILD_CREATE", guild_payload())]:
+            bot._connection._add_guild_from_data(data)
+        events = [event for event in events if event[0] != "GUILD_CREATE" and event[0] in bot._connection.parsers]
+
+        # Warm up caches and prepared statements so they don't skew the numbers
+        for name, data in events[:options.warmup]:
+            await bot.replay(name, data)
+        events = events[options.warmup:]
+
+        latencies = {}
+        semaphore = asyncio.Semaphore(options.concurrency)
+
+        async def replay(name, data):
+            async with semaphore:
+                latencies.setdefault(name, []).append(await bot.replay(name, data))
+
+        gc.collect()
+        blocks = sys.getallocatedblocks()
+        collections = gc.get_stats()[0]["collections"]
+        requests = stand_in.requests
+        started_at = time.perf_counter()
+
+        await asyncio.gather(*[replay(name, data) for name, data in events])
+
+        elapsed = time.perf_counter() - started_at
+        gc.collect()
+        retained = sys.getallocatedblocks() - blocks
+        gen0_collections = gc.get_stats()[0]["collections"] - collections
+        http_requests = stand_in.requests - requests
+
+        # Tracing allocations slows everything down, so it's a separate pass over some of the events.
+        # The peak above what was already allocated counts memory a handler allocates even if it frees all of it.
+        allocations = []
+        tracemalloc.start()
+        for name, data in events[:options.allocation_sample]:
+            tracemalloc.reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+            await bot.replay(name, data)
+            allocations.append(tracemalloc.get_traced_memory()[1] - before)
+        tracemalloc.stop()
+        allocations.sort()
+
+        results = {
+            "events": len(events),
+            "concurrency": options.concurrency,
+            "elapsed_s": round(elapsed, 3),
+            "events_per_s": round(len(events) / elapsed, 1) if elapsed else 0,
+            "overall": summarize(list(itertools.chain.from_iterable(latencies.values()))),
+            "by_event": {name: summarize(values) for name, values in sorted(latencies.items())},
+            "allocations_per_event": {
+                "events": len(allocations),
+                "mean_kb": round(sum(allocations) / max(len(allocations), 1) / 1024, 2),
+                "p99_kb": round(percentile(allocations, 99) / 1024, 2)
+            },
+            "blocks_retained_per_event": round(retained / max(len(events), 1), 2),
+            "gen0_collections_per_1k_events": round(gen0_collections * 1000 / max(len(events), 1), 2),
+            "http_requests_per_event": round(http_requests / max(len(events), 1), 3),
+            "errors": bot.errors
+        }
+
+        await bot.close()
+
+    await stand_in.close()
+    return results
+
+def print_results(results):
+    print(f"{results['events']} events in {results['elapsed_s']}s ({results['events_per_s']} events/s, concurrency {results['concurrency']})")
+    print(f"{'Event':<24}{'Count':>8}{'P50':>12}{'P99':>12}{'Max':>12}")
+    for name, stats in [*results["by_event"].items(), ("overall", results["overall"])]:
+        print(f"{name:<24}{stats['count']:>8}{stats['p50_ms']:>10.2f}ms{stats['p99_ms']:>10.2f}ms{stats['max_ms']:>10.2f}ms")
+    allocations = results["allocations_per_event"]
+    print(f"Allocations per event: {allocations['mean_kb']}KB mean, {allocations['p99_kb']}KB p99 (over {allocations['events']} events)")
+    print(f"Blocks retained per event: {results['blocks_retained_per_event']}")
+    print(f"Gen 0 collections per 1k events: {results['gen0_collections_per_1k_events']}")
+    print(f"HTTP requests per event: {results['http_requests_per_event']}")
+    print(f"Handler errors: {results['errors']}")
+
+def compare(results, baseline, tolerance):
+    # Returns the regressions beyond the tolerance, so CI can fail on them
+    regressions = []
+
+    if results["events_per_s"] < baseline["events_per_s"] * (1 - tolerance):
+        regressions.append(f"throughput fell from {baseline['events_per_s']} to {results['events_per_s']} events/s")
+
+    for name, stats in results["by_event"].items():
+        before = baseline["by_event"].get(name)
+        if before and stats["p99_ms"] > before["p99_ms"] * (1 + tolerance):
+            regressions.append(f"{name} p99 rose from {before['p99_ms']}ms to {stats['p99_ms']}ms")
+
+    before = baseline.get("allocations_per_event")
+    if before and results["allocations_per_event"]["mean_kb"] > before["mean_kb"] * (1 + tolerance):
+        regressions.append(f"allocations rose from {before['mean_kb']}KB to {results['allocations_per_event']['mean_kb']}KB per event")
+
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay gateway events into the bot and measure handler latency.")
+    parser.add_argument("--database-uri", default=os.environ.get("ROBO_CODER_REPLAY_DATABASE_URI"), help="Local Postgres to run against")
+    parser.add_argument("--file", help="JSON-lines file of recorded gateway dispatches")
+    parser.add_argument("--events", type=int, default=10000, help="Number of synthetic events")
+    parser.add_argument("--warmup", type=int, default=500, help="Events to replay before measuring")
+    parser.add_argument("--concurrency", type=int, default=1, help="Events in flight at once")
+    parser.add_argument("--allocation-sample", type=int, default=500, help="Events to replay again while tracing allocations")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="Write the results to this file")
+    parser.add_argument("--compare", help="Fail if the results regressed from this results file")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed regression when comparing")
+    options = parser.parse_args()
+
+    if options.database_uri is None:
+        parser.error("a database URI is required (--database-uri or ROBO_CODER_REPLAY_DATABASE_URI)")
+
+    random.seed(options.seed)
+    logging.getLogger().setLevel(logging.WARNING)
+
+    results = asyncio.run(run(options))
+    print_results(results)
+
+    if options.json:
+        with open(options.json, "w") as file:
+            json.dump(results, file, indent=4)
+
+    if options.compare:
+        with open(options.compare) as file:
+            regressions = compare(results, json.load(file), options.tolerance)
+
+        for regression in regressions:
+            print(f"Regression: {regression}")
+        if regressions:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
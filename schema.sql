@@ -15,6 +15,11 @@ expires_at TIMESTAMP,
 created_at TIMESTAMP DEFAULT (now() at time zone 'utc')
 );
 
+-- Timers tied to a guild are only dispatched by the cluster that owns the guild's shard
+ALTER TABLE timers ADD COLUMN IF NOT EXISTS guild_id BIGINT;
+UPDATE timers SET guild_id=(data->>0)::bigint WHERE guild_id IS NULL AND event IN ('tempban', 'tempmute');
+CREATE INDEX IF NOT EXISTS timers_expires_at_index ON timers (expires_at);
+
 CREATE TABLE IF NOT EXISTS reaction_roles (
 guild_id BIGINT,
 channel_id BIGINT,
@@ -49,6 +54,38 @@ expires_at TIMESTAMP
 
 CREATE UNIQUE INDEX IF NOT EXISTS unique_songs_index ON songs (song_id, extractor);
 
+-- Songs are searched by title, uploader and saved searches with trigram similarity.
+-- This file runs on every start, so the backfill only runs when the column is first added.
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+DO $$
+BEGIN
+    IF NOT EXISTS (SELECT 1 FROM information_schema.columns WHERE table_schema=current_schema() AND table_name='songs' AND column_name='uploader') THEN
+        ALTER TABLE songs ADD COLUMN IF NOT EXISTS uploader TEXT;
+        UPDATE songs SET uploader=data->>'uploader' WHERE data ? 'uploader';
+    END IF;
+END $$;
+CREATE INDEX IF NOT EXISTS songs_title_trgm_index ON songs USING GIN (title gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS songs_uploader_trgm_index ON songs USING GIN (uploader gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS song_searches_search_trgm_index ON song_searches USING GIN (search gin_trgm_ops);
+
+-- Songs used to store yt-dlp's entire info dict, so this keeps only what Song reads (see Song.stored_fields).
+-- Like the uploader backfill, it only runs once, when the columns are added.
+DO $$
+BEGIN
+    IF NOT EXISTS (SELECT 1 FROM information_schema.columns WHERE table_schema=current_schema() AND table_name='songs' AND column_name='url') THEN
+        ALTER TABLE songs ADD COLUMN IF NOT EXISTS duration INT;
+        ALTER TABLE songs ADD COLUMN IF NOT EXISTS url TEXT;
+        UPDATE songs
+        SET duration=(data->>'duration')::numeric::int,
+            url=data->>'webpage_url',
+            data=COALESCE((SELECT jsonb_object_agg(key, value)
+                           FROM jsonb_each(songs.data)
+                           WHERE key IN ('id', 'extractor', 'title', 'uploader', 'uploader_url', 'upload_date', 'duration', 'thumbnail',
+                                         'description', 'tags', 'webpage_url', 'view_count', 'like_count', 'dislike_count')), '{}'::jsonb)
+        WHERE data ? 'webpage_url';
+    END IF;
+END $$;
+
 CREATE TABLE IF NOT EXISTS message_logs (
     guild_id BIGINT PRIMARY KEY,
     channel_id BIGINT